@@ -1,27 +1,46 @@
-import os
+"""Lambda entry point. Each action's module is only imported by its first
+invocation in a container, so the hourly update never loads the training
+dependencies. The Mongo client of data is created on first use & reused
+by warm invocations.
+"""
+import importlib
 import time
 
-from scripts.retrain_models import retrain_models
-from scripts.update_data import update_data
-from scripts.update_pred import update_pred
+from metrics import emit, profile, reset
 
-MONGO_URI = os.environ['MONGO_URI']
+# action -> (module, function), anything else runs updateData
+ACTIONS = {'updateData': ('scripts.update_data', 'update_data'),
+           'updatePred': ('scripts.update_pred', 'update_pred'),
+           'retrain': ('scripts.retrain_models', 'retrain_models')}
+
+
+def get_action(action):
+    """Import the module of an action & return its function."""
+    module, function = ACTIONS[action]
+    return getattr(importlib.import_module(module), function)
 
 
 def handler(event, context):
     action = event.get('action')
+    if action not in ACTIONS:
+        action = 'updateData'
+    kwargs = dict()
+    if action == 'retrain':
+        # Routine retrains update the models, "full" mode searches anew
+        kwargs['incremental'] = event.get('mode') != 'full'
+
+    reset()
     time_start = time.time()
-    if action == 'updatePred':
-        update_pred()
-    elif action == 'retrain':
-        retrain_models()
-    else:
-        update_data()
-    m, s = divmod(time.time()-time_start, 60)
+    # {"profile": "cprofile"} or "pyinstrument" prints a profile of the run
+    with profile(event.get('profile')):
+        get_action(action)(**kwargs)
+    elapsed = time.time()-time_start
+    emit(action, elapsed)
+    m, s = divmod(elapsed, 60)
     h, m = divmod(m, 60)
     runtime = '%03d:%02d:%02d' % (h, m, s)
 
     return {
         'statusCode': 200,
         'runtime': runtime
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,209 @@
+"""End-to-end benchmark of the backend jobs & the dashboard callbacks
+against the local stand-ins of benchmarks.standin: seeds years of history
+for all farms, then runs a reduced train_models, update_pred, the hourly
+update_data & every dashboard callback, each twice where the second run
+shows the cached or incremental path. Each stage asserts on what it did,
+e.g. the documents written, that the hourly weather & power meet on one
+grid. Reports wall time, items per second & peak RSS after each stage.
+Run from backend root folder: python -m benchmarks.end_to_end
+mongomock is needed unless --mongo-uri points at a scratch mongod, see
+benchmarks/requirements.txt.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks import standin
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FRONTEND = os.path.join(os.path.dirname(BACKEND), 'frontend')
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB, NaN if unknown."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float('nan')
+    # ru_maxrss is in kB on Linux & in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_stage(results, name, unit, func, *args, verbose=False, **kwargs):
+    """Time func, which returns the number of items it processed, and
+    record it in results. Its output is hidden unless verbose.
+    """
+    out = sys.stdout if verbose else io.StringIO()
+    time_start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        items = func(*args, **kwargs)
+    elapsed = time.perf_counter() - time_start
+    results.append((name, elapsed, items, unit, peak_rss()))
+    print(f'{name:<24}{elapsed:>10.2f}s')
+
+
+def load_dashboard(client):
+    """Import frontend/app.py as the dashboard module on client."""
+    sys.path.append(FRONTEND)
+    spec = importlib.util.spec_from_file_location(
+        'dashboard', os.path.join(FRONTEND, 'app.py'))
+    dashboard = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dashboard)
+
+    import db
+    db.DB = client['wpp']
+    return dashboard, db
+
+
+def run_callbacks(dashboard, farms):
+    """Call every dashboard callback for each farm & range."""
+    days = [option['value'] for option in dashboard.RANGE_OPTIONS]
+    calls = 0
+    for day in days:
+        dashboard.update_state_plot(day)
+        calls += 1
+        for farm in farms:
+            dashboard.update_forecast_plot(farm, day)
+            dashboard.update_weather_plot(farm, day)
+            calls += 2
+    for farm in farms:
+        dashboard.update_plot_title(farm)
+        dashboard.update_weather(farm)
+        calls += 2
+    return calls
+
+
+def main(years, train_farms, max_evals, mongo_uri=None, verbose=False):
+    server = standin.serve()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        standin.configure(server, workdir)
+        sys.path.insert(0, BACKEND)
+        import data
+        from data import FARM_LIST
+        from models import train_models
+        from scripts.update_data import update_data
+        from scripts.update_pred import update_pred
+        from scripts.update_rollups import rebuild_rollups
+
+        client = standin.connect(mongo_uri)
+        data._client = client
+        from metrics import reset, snapshot
+
+        def count_docs(query=None):
+            return sum(client['wpp'][farm].count_documents(query or {})
+                       for farm in FARM_LIST)
+
+        def rows_written():
+            return sum(value for (name, _), value
+                       in snapshot()['counters'].items()
+                       if name == 'rows_written')
+
+        def check_docs():
+            """Every hour is one document on the HH:30 grid with weather &
+            a prediction, so the power joined hours that had weather.
+            """
+            off_grid = count_docs({'_id': {'$not': {'$regex': ':30:00$'}}})
+            assert off_grid == 0, f'{off_grid} documents off the HH:30 grid'
+            for field in ('wind_speed', 'prediction'):
+                missing = count_docs({field: {'$exists': False}})
+                assert missing == 0, f'{missing} documents without {field}'
+
+        def seed():
+            total = standin.seed(client, years)
+            assert count_docs() == total
+            return total
+
+        def train():
+            trained = train_models(FARM_LIST[:train_farms],
+                                   max_evals=max_evals, n_workers=1)
+            assert len(trained) == train_farms, trained
+            return len(trained)
+
+        def repredict(expected):
+            reset()
+            update_pred()
+            total = count_docs()
+            assert rows_written() == (total if expected is None
+                                      else expected), rows_written()
+            return total
+
+        def rollups():
+            rebuild_rollups()
+            for farm in FARM_LIST:
+                assert client['wpp'][f'{farm}_daily'].count_documents({})
+            return count_docs()
+
+        def hourly_update():
+            before = count_docs()
+            report = update_data()
+            failed = {f: t['error'] for f, t in report.items() if 'error' in t}
+            assert not failed, failed
+            check_docs()
+            # Only future hours are new, the past ones were seeded
+            added = count_docs() - before
+            assert 0 <= added <= len(FARM_LIST) * 3 * 24, added
+            return len(report)
+
+        def callbacks():
+            calls = run_callbacks(dashboard, FARM_LIST)
+            assert calls == len(dashboard.RANGE_OPTIONS) * (
+                1 + 2 * len(FARM_LIST)) + 2 * len(FARM_LIST), calls
+            return calls
+
+        kwargs = {'verbose': verbose}
+        run_stage(results, 'seed', 'docs', seed, **kwargs)
+        run_stage(results, 'train_models', 'farms', train, **kwargs)
+        if train_farms < len(FARM_LIST):
+            # Untrained farms reuse the first model so every farm predicts
+            from model_store import model_path, read_manifest, save_model
+            from xgboost import Booster
+            model = Booster(model_file=model_path(FARM_LIST[0]))
+            dt_range = read_manifest()[FARM_LIST[0]]['dt_range']
+            for farm in FARM_LIST[train_farms:]:
+                save_model(farm, model, dt_range)
+        run_stage(results, 'update_pred', 'docs', repredict, None, **kwargs)
+        run_stage(results, 'update_pred (no-op)', 'docs', repredict, 0,
+                  **kwargs)
+        run_stage(results, 'rebuild_rollups', 'docs', rollups, **kwargs)
+        run_stage(results, 'update_data', 'farms', hourly_update, **kwargs)
+        run_stage(results, 'update_data (cached)', 'farms', hourly_update,
+                  **kwargs)
+
+        dashboard, db = load_dashboard(client)
+        db.clear_cache()
+        run_stage(results, 'callbacks (cold)', 'calls', callbacks, **kwargs)
+        run_stage(results, 'callbacks (warm)', 'calls', callbacks, **kwargs)
+        os.chdir(BACKEND)
+    server.shutdown()
+
+    print(f'\n{"stage":<24}{"wall":>11}{"items":>10}{"unit":>7}'
+          f'{"items/s":>12}{"peak RSS":>12}')
+    for name, elapsed, items, unit, rss in results:
+        print(f'{name:<24}{elapsed:>10.2f}s{items:>10}{unit:>7}'
+              f'{items / elapsed:>12.1f}{rss:>9.0f} MB')
+    print(f'{"total":<24}{sum(r[1] for r in results):>10.2f}s')
+    print(f'HTTP requests: {standin.Handler.counts}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--years', type=float, default=2,
+                        help='years of hourly history per farm')
+    parser.add_argument('--train-farms', type=int, default=3,
+                        help='farms to train, the others reuse a model')
+    parser.add_argument('--max-evals', type=int, default=3,
+                        help='hyperopt trials per trained farm')
+    parser.add_argument('--mongo-uri',
+                        help='scratch mongod to use instead of mongomock')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the output of each stage')
+    args = parser.parse_args()
+    main(args.years, args.train_farms, args.max_evals, args.mongo_uri,
+         args.verbose)
@@ -0,0 +1,79 @@
+"""Benchmark data.fill_val against the original row-by-row loop.
+Run from backend root folder: python -m benchmarks.fill_val
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from data import fill_val
+
+DAYS = [30, 90, 365]
+OFFSET = 288  # 5min interval
+
+
+def fill_val_loop(raw, offset):
+    """The original row-by-row fill_val, kept as the baseline."""
+    df = raw.copy(deep=True)
+    for item in df.drop('time', axis=1).columns:
+        for i in df[df.isna().any(axis=1)].index:
+            try:
+                v_plus = df[item][i+offset]
+            except KeyError:
+                v_plus = np.nan
+            try:
+                v_minus = df[item][i-offset]
+            except KeyError:
+                v_minus = np.nan
+
+            if not pd.isnull(v_plus) and not pd.isnull(v_minus):
+                v = 0.5 * (v_plus + v_minus)
+            elif pd.isnull(v_plus):
+                v = v_minus
+            elif pd.isnull(v_minus):
+                v = v_plus
+            else:
+                v = np.nan
+
+            df.loc[i, item] = v
+    return df
+
+
+def synthetic_power(days, seed=0, outages=1):
+    """5min power series with a few outage of up to 6 hours per day."""
+    rng = np.random.default_rng(seed)
+    n = days * OFFSET
+    time = pd.date_range('2020-01-01', periods=n, freq='5min', name='time')
+    actual = 50 + 40 * np.sin(np.arange(n) * 2 * np.pi / OFFSET) \
+        + rng.normal(0, 5, n)
+    for start in rng.integers(0, n, days * outages):
+        actual[start:start + rng.integers(1, 72)] = np.nan
+
+    return pd.DataFrame({'time': time, 'actual': actual})
+
+
+def timed(func, *args, **kwargs):
+    time_start = time.perf_counter()
+    out = func(*args, **kwargs)
+    return out, time.perf_counter() - time_start
+
+
+def main():
+    print(f'{"days":>5} {"rows":>7} {"missing":>8} {"loop (s)":>9} '
+          f'{"vector (s)":>10} {"speedup":>8} {"max diff":>9}')
+    for days in DAYS:
+        raw = synthetic_power(days)
+        expected, t_loop = timed(fill_val_loop, raw, OFFSET)
+        result, t_vec = timed(fill_val, raw, OFFSET)
+
+        # The loop also reads -24h values it has already filled itself, so
+        # only compare rows whose -24h value is in the raw data
+        same = raw.actual.isna() & raw.actual.shift(OFFSET).notna()
+        diff = np.abs(expected.actual[same] - result.actual[same]).max()
+        print(f'{days:>5} {len(raw):>7} {raw.actual.isna().sum():>8} '
+              f'{t_loop:>9.3f} {t_vec:>10.4f} {t_loop / t_vec:>7.0f}x '
+              f'{diff:>9.2g}')
+
+
+if __name__ == '__main__':
+    main()
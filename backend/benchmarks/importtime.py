@@ -0,0 +1,74 @@
+"""Report the cold import time of the Lambda handler & of each action,
+parsed from python -X importtime in a fresh interpreter without MONGO_URI.
+With --check, exit with an error if the hourly updateData path imports a
+training-only dependency.
+Run from backend root folder: python -m benchmarks.importtime [--check]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOURLY = 'updateData'
+TRAINING_ONLY = ['models', 'hyperopt', 'networkx', 'compress_pickle']
+TOP = 10
+
+
+def import_times(code):
+    """Run code under -X importtime, return (module, self us, cumulative
+    us, depth) of every module imported.
+    """
+    env = {k: v for k, v in os.environ.items() if k != 'MONGO_URI'}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=BACKEND, env=env, capture_output=True,
+                            text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us),
+                        depth))
+    return modules
+
+
+def report(label, modules):
+    """Print the total & the slowest top-level imports."""
+    total = sum(m[1] for m in modules) / 1000
+    print(f'\n{label}: {len(modules)} modules, {total:.1f} ms')
+    top = sorted((m for m in modules if m[3] <= 1), key=lambda m: -m[2])
+    print(f'{"module":<40}{"self":>12}{"cumulative":>14}')
+    for name, self_us, cumulative_us, _ in top[:TOP]:
+        print(f'{name:<40}{self_us / 1000:>10.1f}ms'
+              f'{cumulative_us / 1000:>12.1f}ms')
+
+
+def main(check=False):
+    from app import ACTIONS
+
+    targets = [('app', 'import app')]
+    targets += [(action, f'import app; app.get_action({action!r})')
+                for action in ACTIONS]
+    loaded = dict()
+    for label, code in targets:
+        modules = import_times(code)
+        loaded[label] = {name.split('.')[0] for name, *_ in modules}
+        report(label, modules)
+
+    if check:
+        found = sorted(loaded[HOURLY] & set(TRAINING_ONLY))
+        if found:
+            sys.exit(f'\n{HOURLY} imports training-only modules: '
+                     f'{", ".join(found)}')
+        print(f'\n{HOURLY} imports no training-only modules')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='store_true',
+                        help=f'fail if {HOURLY} imports any of '
+                             f'{", ".join(TRAINING_ONLY)}')
+    args = parser.parse_args()
+    main(args.check)
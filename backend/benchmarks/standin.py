@@ -0,0 +1,262 @@
+"""Local stand-ins for MongoDB, Dark Sky & AREMI, so the backend scripts &
+the dashboard can run without network access or credentials.
+
+The HTTP server answers the three requests the code makes (the AREMI wind
+overview, AREMI 5min power csv & Dark Sky day forecasts) from synthetic
+series. Every series is a fixed function of time & farm, so a response is
+the same however often, or over whatever range, it is requested, like a
+recorded one. The database is mongomock unless a mongo URI is given, see
+connect.
+
+configure must run before data, farms, models or the scripts are imported,
+they read the endpoints from the environment at import time.
+"""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+TZ = 'Australia/Adelaide'
+DARKSKY_KEY = 'standin'
+# Rated capacity & location of the synthetic farms, in FARMS order
+CAPACITY = [100, 50, 280, 130, 90, 95, 110, 200, 70, 140, 270, 100, 45]
+WEATHER_FIELDS = {'cloudCover': 'cloud_cover', 'dewPoint': 'dew_point',
+                  'humidity': 'humidity', 'ozone': 'ozone',
+                  'precipIntensity': 'precipitation', 'pressure': 'pressure',
+                  'temperature': 'temperature', 'uvIndex': 'uv_index',
+                  'visibility': 'visibility', 'windBearing': 'wind_bearing',
+                  'windGust': 'wind_gust', 'windSpeed': 'wind_speed'}
+ICONS = np.array(['clear-day', 'partly-cloudy-day', 'cloudy', 'rain', 'wind'])
+
+
+def farm_index(farm):
+    from farms import FARM_LIST
+    return FARM_LIST.index(farm)
+
+
+def epoch_seconds(times):
+    """Whole seconds since epoch of naive UTC times, whatever their unit."""
+    return (times - pd.Timestamp(0)) // pd.Timedelta('1s')
+
+
+def noise(hours, seed):
+    """Deterministic noise in [0, 1) for fractional hours since epoch."""
+    x = np.sin(hours * 12.9898 + seed * 78.233) * 43758.5453
+    return x - np.floor(x)
+
+
+def wind_speed(hours, seed):
+    """Wind speed in m/s with a seasonal & daily cycle plus noise."""
+    season = np.sin(2 * np.pi * hours / (365.25 * 24) + seed)
+    daily = np.sin(2 * np.pi * hours / 24 + seed / 3)
+    return np.clip(8 + 3 * season + 2 * daily
+                   + 4 * (noise(np.floor(hours), seed) - 0.5), 0, None)
+
+
+def synthetic_weather(farm, times):
+    """Hourly weather of a farm at naive UTC times, under the DB names."""
+    seed = farm_index(farm)
+    hours = np.asarray(epoch_seconds(times) / 3600)
+    speed = wind_speed(hours, seed)
+    temp = 18 + 8 * np.sin(2 * np.pi * hours / (365.25 * 24)) \
+        + 5 * np.sin(2 * np.pi * (hours - 9) / 24)
+    return pd.DataFrame({
+        'time': times,
+        'cloud_cover': noise(hours, seed + 1),
+        'dew_point': temp - 5 * noise(hours, seed + 2),
+        'humidity': 0.3 + 0.6 * noise(hours, seed + 3),
+        'ozone': 280 + 30 * noise(hours, seed + 4),
+        'precipitation': np.where(noise(hours, seed + 5) > 0.9,
+                                  noise(hours, seed + 6), 0.0),
+        'pressure': 1000 + 25 * noise(hours, seed + 7),
+        'temperature': temp,
+        'uv_index': np.round(np.clip(10 * np.sin(
+            2 * np.pi * (hours - 20) / 24), 0, None)),
+        'visibility': 16.09 * noise(hours, seed + 8),
+        'wind_bearing': np.round(360 * noise(hours, seed + 9)),
+        'wind_gust': speed * (1.3 + 0.4 * noise(hours, seed + 10)),
+        'wind_speed': speed,
+        'icon': ICONS[(5 * noise(hours, seed + 11)).astype(int)],
+    })
+
+
+def synthetic_power(farm, times):
+    """Output in MW of a farm at naive UTC times, from a cubic power
+    curve of its wind speed, with some negative auxiliary load readings.
+    """
+    seed = farm_index(farm)
+    hours = np.asarray(epoch_seconds(times) / 3600)
+    load = np.clip((wind_speed(hours, seed) - 3) / 9, 0, 1) ** 3
+    return CAPACITY[seed] * load + 2 * noise(hours * 12, seed) - 0.5
+
+
+def history(farm, start, end):
+    """Hourly documents of a farm from start to end as in the database:
+    weather & actual power, no predictions yet. start sets the grid, the
+    real one is HH:30 UTC, the Adelaide hours.
+    """
+    times = pd.date_range(start, end, freq='60min', inclusive='left')
+    df = synthetic_weather(farm, times)
+    df['actual'] = np.clip(synthetic_power(farm, times), 0, None)
+    df['time'] = times.strftime('%Y-%m-%d %H:%M:%S')
+    return df.rename(columns={'time': '_id'})
+
+
+def location(i):
+    """Latitude & longitude of the i-th farm."""
+    return -33.0 - 0.3 * i, 138.0 + 0.2 * i
+
+
+def overview_csv():
+    """The AREMI wind overview: name, current output, DUID & location."""
+    from farms import FARMS
+    now = pd.DatetimeIndex([pd.Timestamp.now('UTC').tz_localize(None)])
+    rows = ['Station Name,Current Output (MW),DUID,Lat,Lon']
+    for i, (duid, name) in enumerate(FARMS.items()):
+        power = max(synthetic_power(duid, now)[0], 0)
+        lat, lon = location(i)
+        rows.append(f'{name},{power:.2f},{duid},{lat:.4f},{lon:.4f}')
+    return '\n'.join(rows) + '\n'
+
+
+def power_csv(farm, offset_days):
+    """The last offset_days of 5min AREMI output of a farm."""
+    end = pd.Timestamp.now('UTC').tz_localize(None).floor('5min')
+    times = pd.date_range(end - pd.Timedelta(days=offset_days), end,
+                          freq='5min')
+    power = synthetic_power(farm, times)
+    stamps = times.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    return 'Time,Power (MW)\n' + ''.join(
+        f'{t},{p:.3f}\n' for t, p in zip(stamps, power))
+
+
+def forecast_json(lat, lon, day):
+    """A Dark Sky time machine response: the hourly weather of the local
+    day at the farm nearest to lat, lon.
+    """
+    from farms import FARM_LIST
+    farm = min(FARM_LIST, key=lambda f: sum(
+        (a - b)**2 for a, b in zip(location(farm_index(f)), (lat, lon))))
+    start = pd.Timestamp(day, tz=TZ)
+    times = pd.date_range(start, start + pd.Timedelta(days=1), freq='60min',
+                          inclusive='left')
+    times = times.tz_convert('UTC').tz_localize(None)
+    weather = synthetic_weather(farm, times)
+    hourly = weather.rename(
+        columns={v: k for k, v in WEATHER_FIELDS.items()})
+    hourly['time'] = epoch_seconds(times)
+    return json.dumps({'latitude': lat, 'longitude': lon,
+                       'hourly': {'data': hourly.to_dict('records')}})
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Routes /csv/wind, /duidcsv/<farm> & /forecast/<key>/<lat>,<lon>,<t>."""
+    counts = {'aremi': 0, 'darksky': 0}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        try:
+            if parts == ['csv', 'wind']:
+                body, kind, source = overview_csv(), 'text/csv', 'aremi'
+            elif parts[0] == 'duidcsv':
+                offset = parse_qs(url.query).get('offset', ['1D'])[0]
+                body = power_csv(parts[1], int(offset.rstrip('D')))
+                kind, source = 'text/csv', 'aremi'
+            elif parts[0] == 'forecast' and parts[1] == DARKSKY_KEY:
+                lat, lon, day = parts[2].split(',')
+                body = forecast_json(float(lat), float(lon), day)
+                kind, source = 'application/json', 'darksky'
+            else:
+                self.send_error(404)
+                return
+        except (IndexError, KeyError, ValueError) as e:
+            self.send_error(400, repr(e))
+            return
+
+        Handler.counts[source] += 1
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    """Start the HTTP stand-in on a free local port in a daemon thread,
+    returns the server, call shutdown() on it when done.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure(server, workdir):
+    """Point the code at the stand-in & keep its files under workdir."""
+    host, port = server.server_address
+    os.environ['AREMI_API'] = f'http://{host}:{port}'
+    os.environ['DARKSKY_API'] = f'http://{host}:{port}'
+    os.environ['DARKSKY_KEY'] = DARKSKY_KEY
+    os.environ.setdefault('MONGO_URI', 'mongodb://localhost')
+    os.environ['FARM_SNAPSHOT'] = os.path.join(workdir, 'aremi_wind.csv')
+    os.environ['POWER_CACHE_DIR'] = os.path.join(workdir, 'power')
+    os.environ['CACHE_DIR'] = os.path.join(workdir, 'cache')
+    os.makedirs(os.path.join(workdir, 'models'), exist_ok=True)
+    os.chdir(workdir)
+
+
+def connect(mongo_uri=None):
+    """Return a mongomock client, or a real one to mongo_uri. The wpp
+    database of a real server gets overwritten, use a scratch mongod.
+    """
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri)
+    import mongomock
+    from mongomock.collection import Collection
+
+    # mongomock scans every document for each query, which makes the
+    # per-_id bulk updates quadratic. Exact _id matches use the store's
+    # dict instead, like the _id index of a real server.
+    iter_documents = Collection._iter_documents
+
+    def _iter_documents(self, filter):
+        if isinstance(filter, dict) and list(filter) == ['_id'] \
+                and isinstance(filter['_id'], str):
+            if filter['_id'] in self._store:
+                return iter([self._store[filter['_id']]])
+            return iter([])
+        return iter_documents(self, filter)
+
+    Collection._iter_documents = _iter_documents
+    return mongomock.MongoClient()
+
+
+def seed(client, years, batch_size=10000):
+    """Fill every farm collection with years of hourly history up to the
+    current hour, on the HH:30 grid of the Dark Sky & resampled AREMI
+    hours, returns the number of documents inserted.
+    """
+    from farms import FARM_LIST
+    half = pd.Timedelta('30min')
+    end = (pd.Timestamp.now('UTC').tz_localize(None) - half).floor(
+        '60min') + half
+    start = end - pd.Timedelta(days=round(365.25 * years))
+    total = 0
+    for farm in FARM_LIST:
+        for name in (farm, f'{farm}_daily', f'{farm}_weekly'):
+            client['wpp'][name].drop()
+        docs = history(farm, start, end).to_dict('records')
+        for i in range(0, len(docs), batch_size):
+            client['wpp'][farm].insert_many(docs[i:i+batch_size])
+        total += len(docs)
+    return total
@@ -0,0 +1,72 @@
+"""Benchmark peak memory & runtime of models.transform_data against the
+original copy-based version, on a synthetic full-history frame.
+Run from backend root folder: python -m benchmarks.transform_data
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from features import WEATHER_COL, X_COL, transform_data
+
+YEARS = [1, 5, 10]
+
+
+def transform_data_copy(original_df):
+    """The original transform_data, kept as the baseline."""
+    df = original_df.copy(deep=True)
+
+    df['time'] = pd.to_datetime(df['time'], utc=True)
+    df['wind_speed_^_2'] = df['wind_speed']**2
+    df['wind_speed_^_3'] = df['wind_speed']**3
+    df['wind_gust_^_2'] = df['wind_gust']**2
+    df['wind_gust_^_3'] = df['wind_gust']**3
+    df['sin_wind_bearing'] = np.sin(df['wind_bearing'] * np.pi / 180.)
+    df['cos_wind_bearing'] = np.cos(df['wind_bearing'] * np.pi / 180.)
+
+    X = df[X_COL]
+    y = df.actual if 'actual' in df.columns else None
+
+    return X, y
+
+
+def synthetic_history(years, seed=0):
+    """Hourly documents as fetch_data returns them."""
+    rng = np.random.default_rng(seed)
+    n = years * 365 * 24
+    df = pd.DataFrame({col: rng.random(n) * 20 for col in WEATHER_COL})
+    df['wind_bearing'] *= 18
+    df['actual'] = rng.random(n) * 100
+    df['prediction'] = rng.random(n) * 100
+    df['icon'] = 'partly-cloudy-day'
+    df.insert(0, 'time', pd.date_range('2015-01-01', periods=n, freq='h')
+              .strftime('%Y-%m-%d %H:%M:%S'))
+    return df
+
+
+def measure(func, df):
+    """Return the peak traced memory in MB & runtime in s of func(df)."""
+    tracemalloc.start()
+    time_start = time.perf_counter()
+    X, y = func(df)
+    runtime = time.perf_counter() - time_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20, runtime
+
+
+def main():
+    print(f'{"years":>5} {"rows":>7} {"input MB":>9} {"copy MB":>8} '
+          f'{"new MB":>7} {"copy (s)":>9} {"new (s)":>8}')
+    for years in YEARS:
+        df = synthetic_history(years)
+        size = df.memory_usage(deep=True).sum() / 2**20
+        peak_copy, t_copy = measure(transform_data_copy, df)
+        peak_new, t_new = measure(transform_data, df)
+        print(f'{years:>5} {len(df):>7} {size:>9.1f} {peak_copy:>8.1f} '
+              f'{peak_new:>7.1f} {t_copy:>9.3f} {t_new:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,51 @@
+import http.client
+import io
 import os
-import urllib
+import socket
+import tempfile
+import urllib.error
+import urllib.request
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 import arrow
 import numpy as np
 import pandas as pd
 from pymongo import MongoClient, UpdateOne
 
+from farms import AREMI_API, FARM_LIST, FARM_NAME_LIST, get_farm
+from metrics import count, timer
+
 MONGO_URI = os.environ.get('MONGO_URI')
 DARKSKY_KEY = os.environ.get('DARKSKY_KEY')
+DARKSKY_API = os.environ.get('DARKSKY_API', 'https://api.darksky.net')
+BATCH_SIZE = 1000
+MAX_WORKERS = 8
+RETRIES = 3
+POWER_CACHE_DIR = os.environ.get(
+    'POWER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'aremi_power'))
+FILL_CHAIN = 3  # days back fill_val looks for power data
+
+
+
+_client = None
+
+
+@dataclass
+class WriteStats:
+    """Summary of a bulk write."""
+    matched: int = 0
+    upserted: int = 0
+    modified: int = 0
+    skipped: int = 0
+    elapsed: float = 0.0
 
-FARM_LIST = ['BLUFF1', 'CATHROCK', 'CLEMGPWF', 'HALLWF2', 'HDWF2', 
-             'LKBONNY2', 'MTMILLAR', 'NBHWF1', 'SNOWNTH1', 'SNOWSTH1', 
-             'STARHLWF', 'WATERLWF', 'WPWF']
-FARM_NAME_LIST = ['Bluff Wind Farm', 'Cathedral Rocks Wind Farm', 
-                  'Clements Gap Wind Farm','Hallett 2 Wind Farm', 
-                  'Hornsdale Wind Farm 2', 'Lake Bonney Stage 2 Windfarm', 
-                  'Mt Millar Wind Farm', 'North Brown Hill Wind Farm', 
-                  'Snowtown Wind Farm Stage 2 North', 
-                  'Snowtown South Wind Farm', 'Starfish Hill Wind Farm', 
-                  'Waterloo Wind Farm', 'Wattle Point Wind Farm']
+    @property
+    def docs_per_sec(self):
+        docs = self.matched + self.upserted
+        return docs / self.elapsed if self.elapsed > 0 else 0.0
 
 
 def connect_db(MONGO_URI):
@@ -28,17 +53,107 @@ def connect_db(MONGO_URI):
     return MongoClient(MONGO_URI)
 
 
-def fetch_data(client, farm, limit):
-    """Get the last N row of data."""
+def get_client():
+    """Return the pooled client shared by all callers in this process."""
+    global _client
+    if _client is None:
+        _client = connect_db(MONGO_URI)
+    return _client
+
+
+def to_id(dt):
+    """Format a datetime or string as a UTC document _id."""
+    dt = pd.Timestamp(dt)
+    if dt.tzinfo is not None:
+        dt = dt.tz_convert('UTC')
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def time_query(start=None, end=None):
+    """Query for documents from start (inclusive) to end (exclusive)."""
+    id_range = dict()
+    if start is not None:
+        id_range['$gte'] = to_id(start)
+    if end is not None:
+        id_range['$lt'] = to_id(end)
+    return {'_id': id_range} if id_range else {}
+
+
+def frame_from_cursor(cursor, fields):
+    """Build a DataFrame column by column from the documents of a cursor.
+    Float fields become float64 arrays with NaN for missing values, fields
+    that are all int stay int64 so hashes aren't rounded. Anything else,
+    strings or ints mixed with floats or missing values, stays object.
+    """
+    columns = {field: [] for field in ['_id'] + fields}
+    for doc in cursor:
+        for field, values in columns.items():
+            values.append(doc.get(field))
+
+    data = dict()
+    for field, values in columns.items():
+        kinds = {type(v) for v in values if v is not None}
+        if kinds == {int} and None not in values:
+            data[field] = np.array(values, dtype='int64')
+        elif kinds <= {float}:
+            data[field] = np.array(values, dtype='float64')
+        else:
+            # Never parse strings, a hex model_version may look numeric
+            data[field] = np.array(values, dtype=object)
+    return pd.DataFrame(data)
+
+
+def fetch_data(client, farm, limit=None, fields=None, start=None, end=None,
+               chunksize=None, columnar=False, source='mongo'):
+    """Get the last N row of data, or all rows if limit is None.
+    fields limits the returned fields, start & end limit the UTC time range.
+    With chunksize, return a generator of DataFrames of up to chunksize
+    rows in time order instead. columnar builds the columns straight from
+    the cursor, which is faster for large fetches but needs fields.
+    source='cache' syncs the local Parquet cache first and reads from it,
+    it only holds the weather & actual fields & needs pyarrow, see
+    requirements-cache.txt.
+    """
+    if columnar and fields is None:
+        raise ValueError('columnar fetch needs a list of fields')
+    if chunksize is not None:
+        return fetch_chunks(client, farm, chunksize, fields, start, end,
+                            columnar)
+    if source == 'cache':
+        try:
+            from parquet_cache import read_farm, sync_farm
+        except ImportError as e:
+            raise RuntimeError(
+                "source='cache' needs parquet_cache.py & pyarrow, install "
+                'requirements-cache.txt, it is not in the Lambda image') from e
+
+        time_start = time.time()
+        with timer('fetch', farm):
+            synced = sync_farm(client, farm)
+            df = read_farm(farm, fields, start, end, limit)
+        count('rows_fetched', len(df), farm)
+        runtime = round(time.time()-time_start, 2)
+        print(f'Read {len(df)} documents of {farm} from cache, '
+              f'{synced} synced in {runtime} s')
+        return df
+
     time_start = time.time()
     db = client['wpp']
     print(f'Fetching data for {farm}...', end='', flush=True)
     col = db[farm]
-    if limit == None:
-        df = pd.DataFrame(col.find({}, batch_size=10000).sort('_id', -1))
-    else:
-        df = pd.DataFrame(
-            col.find({}, batch_size=1000).sort('_id', -1).limit(limit))
+    query = time_query(start, end)
+    with timer('fetch', farm):
+        if limit == None:
+            cursor = col.find(query, fields, batch_size=10000).sort('_id', -1)
+        else:
+            cursor = col.find(query, fields, batch_size=1000).sort(
+                '_id', -1).limit(limit)
+        if columnar:
+            df = frame_from_cursor(cursor, fields)
+        else:
+            df = pd.DataFrame(cursor)
+    count('rows_fetched', len(df), farm)
+    count('mongo_round_trips', 1, farm)
 
     if '_id' in df.columns:
         df = df.rename(columns={'_id': 'time'})
@@ -50,120 +165,268 @@ def fetch_data(client, farm, limit):
     return df
 
 
-def update_db(farm, update_df, upsert=True):
-    """Update database via bulk write."""
+def fetch_chunks(client, farm, chunksize, fields=None, start=None, end=None,
+                 columnar=False):
+    """Yield documents in time order as DataFrames of chunksize rows."""
+    col = client['wpp'][farm]
+    query = time_query(start, end)
+    id_range = query.get('_id', {})
+    while True:
+        query = {'_id': id_range} if id_range else {}
+        with timer('fetch', farm):
+            cursor = col.find(query, fields, batch_size=chunksize)
+            cursor = cursor.sort('_id', 1).limit(chunksize)
+            if columnar:
+                df = frame_from_cursor(cursor, fields)
+            else:
+                df = pd.DataFrame(cursor)
+        count('rows_fetched', len(df), farm)
+        count('mongo_round_trips', 1, farm)
+        if len(df) == 0:
+            return
+        # Continue after the last _id of this chunk
+        id_range = {k: v for k, v in id_range.items() if k == '$lt'}
+        id_range['$gt'] = df['_id'].iloc[-1]
+        yield df.rename(columns={'_id': 'time'})
+
+
+def changed_fields(record, current):
+    """Return the fields of record that differ from the current document,
+    missing values are left out so they don't overwrite stored ones.
+    """
+    changed = dict()
+    for field, value in record.items():
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            continue
+        if field not in current or current[field] != value:
+            changed[field] = value
+    return changed
+
+
+def update_db(farm, update_df, upsert=True, client=None, batch_size=BATCH_SIZE,
+              changed_only=False):
+    """Update database via unordered bulk writes of batch_size documents.
+    Uses the pooled client unless one is given, returns a WriteStats.
+    With changed_only, the current documents are read in one query and only
+    the fields that changed are set, unchanged documents are skipped.
+    """
+    stats = WriteStats()
     if len(update_df) == 0:
         print('No update found')
-        return
+        return stats
+    time_start = time.time()
     if 'time' in update_df.columns:
         update_df = update_df.rename(columns={'time': '_id'})
-    client = connect_db(MONGO_URI)
-    db = client['wpp']
-    ops = []
-    for i in range(len(update_df)):
-        _id = update_df.iloc[i]._id
-        data = update_df.iloc[i].to_dict()
-        ops.append(UpdateOne({'_id': _id}, {'$set': data}, upsert=upsert))
-    db[farm].bulk_write(ops)
+        if pd.api.types.is_datetime64_any_dtype(update_df['_id']):
+            update_df['_id'] = update_df['_id'].dt.strftime(
+                '%Y-%m-%d %H:%M:%S')
+    if client is None:
+        client = get_client()
+    col = client['wpp'][farm]
+
+    with timer('upsert', farm):
+        records = update_df.to_dict('records')
+        if changed_only:
+            ids = update_df['_id']
+            query = {'_id': {'$gte': ids.min(), '$lte': ids.max()}}
+            current = {doc['_id']: doc for doc in col.find(query)}
+            count('mongo_round_trips', 1, farm)
+            updates = [(data['_id'],
+                        changed_fields(data, current.get(data['_id'], {})))
+                       for data in records]
+            ops = [UpdateOne({'_id': _id}, {'$set': fields}, upsert=upsert)
+                   for _id, fields in updates if fields]
+            stats.skipped = len(records) - len(ops)
+        else:
+            ops = [UpdateOne({'_id': data['_id']}, {'$set': data},
+                             upsert=upsert)
+                   for data in records]
+        for i in range(0, len(ops), batch_size):
+            result = col.bulk_write(ops[i:i+batch_size], ordered=False)
+            count('mongo_round_trips', 1, farm)
+            stats.matched += result.matched_count
+            stats.upserted += result.upserted_count
+            stats.modified += result.modified_count
+    count('rows_written', len(ops), farm)
+
+    stats.elapsed = time.time()-time_start
+    print(f'Wrote {farm}: {stats.matched} matched, {stats.upserted} upserted, '
+          f'{stats.modified} modified, {stats.skipped} unchanged in '
+          f'{round(stats.elapsed, 2)} s ({round(stats.docs_per_sec)} docs/s)')
+
+    return stats
+
+
+def mark_update(client):
+    """Record the time of the last update, the dashboard clears its cache
+    when this changes.
+    """
+    client['wpp']['meta'].update_one(
+        {'_id': 'last_update'},
+        {'$set': {'time': arrow.utcnow().format('YYYY-MM-DD HH:mm:ss')}},
+        upsert=True)
 
 
-def fill_val(raw, offset):
+def fill_val(raw, offset, chain=1):
     """Fill missing value with the mean of the -24h and +24h data.
     offset is the rows for the +24h/-24h, for 1h interval is 24, 
-    for 5min interval is 288.
+    for 5min interval is 288. With chain > 1, values still missing after
+    that are filled from -48h, -72h... up to chain days back.
     """
     df = raw.copy(deep=True)
     for item in df.drop('time', axis=1).columns:
-        for i in df[df.isna().any(1)].index:
-            # Take into consideration if missing values don't have -24h and +24h data
-            try:
-                v_plus = df[item][i+offset]
-            except:
-                v_plus = np.nan
-            try:
-                v_minus = df[item][i-offset]
-            except:
-                v_minus = np.nan
-
-            # fill with the with the mean of the -24h and +24h data if they both exist
-            # otherwise, just fill with the one that exists
-            if not pd.isnull(v_plus) and not pd.isnull(v_minus):
-                v = 0.5 * (v_plus + v_minus)
-            elif pd.isnull(v_plus):
-                v = v_minus
-            elif pd.isnull(v_minus):
-                v = v_plus
-            else:
-                v = np.nan
-
-            df.loc[i, item] = v
+        col = df[item]
+        missing = col.isna()
+        if not missing.any():
+            continue
+
+        # Shifted arrays line up the -24h and +24h data with each row; rows
+        # beyond either end of the series come back as NaN
+        v_minus = col.shift(offset)
+        v_plus = col.shift(-offset)
+
+        # fill with the with the mean of the -24h and +24h data if they both exist
+        # otherwise, just fill with the one that exists
+        if pd.api.types.is_numeric_dtype(col):
+            v = (0.5 * (v_minus + v_plus)).fillna(v_minus).fillna(v_plus)
+        else:
+            v = v_minus.fillna(v_plus)
+
+        # Look further back for long outages where both neighbours are missing
+        for day in range(2, chain + 1):
+            v = v.fillna(col.shift(day * offset))
+
+        df[item] = col.where(~missing, v)
     return df
 
 
+def read_power_csv(farm, offset):
+    """Download the last offset days of 5min power data of a farm, with
+    time as naive UTC datetime64.
+    """
+    raw = pd.read_csv(io.BytesIO(
+        fetch_url(f'{AREMI_API}/duidcsv/{farm}?offset={offset}D')))
+    raw.columns = ['time', 'actual']
+    raw['time'] = pd.to_datetime(raw['time'], utc=True).dt.tz_localize(None)
+    return raw
+
+
+def power_day_file(farm, day):
+    return os.path.join(POWER_CACHE_DIR, farm, f'{day:%Y-%m-%d}.csv')
+
+
+def get_raw_power(farm, utc_start, utc_end):
+    """Get the 5min power data of a farm from utc_start to utc_end (naive
+    UTC). Complete days are cached per farm & day under POWER_CACHE_DIR,
+    so only the days from the first uncached one on are downloaded.
+    """
+    days = pd.date_range(utc_start.floor('D'), utc_end, freq='D',
+                         inclusive='left')
+    missing = [day for day in days
+               if not os.path.exists(power_day_file(farm, day))]
+    cached = [day for day in days if not missing or day < missing[0]]
+    frames = [pd.read_csv(power_day_file(farm, day), parse_dates=['time'])
+              for day in cached]
+
+    if missing:
+        now = pd.Timestamp.now('UTC').tz_localize(None)
+        raw = read_power_csv(farm, (now.floor('D') - missing[0]).days + 1)
+        frames.append(raw)
+
+        # The first & last day of the download are partial
+        os.makedirs(os.path.join(POWER_CACHE_DIR, farm), exist_ok=True)
+        day_key = raw['time'].dt.floor('D')
+        for day in missing:
+            if day_key.iat[0] < day < day_key.iat[-1]:
+                tmp = f'{power_day_file(farm, day)}.{os.getpid()}.tmp'
+                raw[day_key == day].to_csv(tmp, index=False)
+                os.replace(tmp, power_day_file(farm, day))
+
+    # The download can start before the first missing day
+    raw = pd.concat(frames, ignore_index=True).drop_duplicates(
+        'time', keep='last')
+    return raw[(raw['time'] >= utc_start) & (raw['time'] < utc_end)]
+
+
 def get_power(farm, local_start_dt, local_end_dt):
-    """Get power data & convert it to 1h format."""
+    """Get power data & convert it to 1h format, time stays naive UTC."""
     tz = 'Australia/Adelaide'
-    utc_start_dt = pd.to_datetime(
-        local_start_dt).tz_localize(tz).tz_convert('UTC')
-    utc_end_dt = pd.to_datetime(local_end_dt).tz_localize(tz).tz_convert('UTC')
+    utc_start_dt, utc_end_dt = (
+        pd.Timestamp(dt).tz_localize(tz).tz_convert('UTC').tz_localize(None)
+        for dt in (local_start_dt, local_end_dt))
 
-    offset = (arrow.now() - arrow.get(local_start_dt)).days + 2
-    power_api = f'https://services.aremi.data61.io/aemo/v6/duidcsv/{farm}?offset={offset}D'
-
-    raw = pd.read_csv(power_api)
-    raw.columns = ['time', 'actual']
-    raw['time'] = pd.to_datetime(raw['time'])
+    # Only the window plus the rows fill_val reads around it
+    raw = get_raw_power(farm, utc_start_dt - pd.Timedelta(days=FILL_CHAIN),
+                        utc_end_dt + pd.Timedelta(days=1))
 
     # Ensure no vacant in the time series
-    reference_idx = pd.date_range(start=raw.iloc[0].time,
-                                  end=raw.iloc[-1].time,
+    reference_idx = pd.date_range(start=raw['time'].iat[0],
+                                  end=raw['time'].iat[-1],
                                   freq='5min',
                                   name='time')
+    with timer('fill', farm):
+        raw = raw.set_index('time').reindex(reference_idx).reset_index()
+        raw = fill_val(raw, offset=288, chain=FILL_CHAIN)
 
-    raw = raw.set_index('time').reindex(reference_idx).reset_index()
-    raw = fill_val(raw, offset=288)
-
-    # Slice the raw df to a desired range
-    power_5min = raw[(raw['time'] >= utc_start_dt)
-                     & (raw['time'] < utc_end_dt)]
+    # Slice to the window, rectify negative values & aggregate by the hour
+    in_range = ((raw['time'] >= utc_start_dt)
+                & (raw['time'] < utc_end_dt)).to_numpy()
+    actual = pd.Series(np.maximum(raw['actual'].to_numpy()[in_range], 0),
+                       index=raw['time'].to_numpy()[in_range])
+    power_1h = actual.resample('60min', offset='30min', label='left').mean()
 
-    # rectify negative value
-    neg_idx = power_5min[power_5min.actual < 0].index
-    power_5min.loc[neg_idx, 'actual'] = 0
+    return power_1h.rename_axis('time').rename('actual').reset_index()
 
-    # aggregate by the hour
-    power_1h = power_5min.set_index('time')['actual'].resample(
-        '60min', offset='30min', label='left').mean().reset_index()
-    power_1h.time = power_1h.time.dt.strftime('%Y-%m-%d %H:%M:%S')
 
-    return power_1h
-
-
-def get_weather(farm, local_start_dt, local_end_dt):
+def fetch_url(url, retries=RETRIES, backoff=1.0, timeout=30):
+    """Get the body of a response, retry with exponential backoff on
+    network errors, 429 and 5xx responses.
+    """
+    for attempt in range(retries + 1):
+        count('http_calls')
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                body = response.read()
+            count('http_bytes', len(body))
+            return body
+        except urllib.error.HTTPError as e:
+            if (e.code != 429 and e.code < 500) or attempt == retries:
+                raise
+        # socket.timeout is only a TimeoutError from Python 3.10 on, a read
+        # timeout of the body raises it on the 3.9 Lambda runtime
+        except (urllib.error.URLError, ConnectionError, TimeoutError,
+                socket.timeout, http.client.IncompleteRead):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def fetch_json(url, retries=RETRIES, backoff=1.0, timeout=30):
+    """Get a JSON response, retried like fetch_url."""
+    return json.loads(fetch_url(url, retries, backoff, timeout).decode())
+
+
+def get_weather(farm, local_start_dt, local_end_dt, max_workers=MAX_WORKERS):
     """Get weather data from Darksky.
     local_start_dt and local_end_dt are strings in format of %Y-%m-%d %H:%M:%S.
-    Return a dataframe with hourly weather data.
+    Return a dataframe with hourly weather data, time is naive UTC.
     """
-    overview = pd.read_csv('https://services.aremi.data61.io/aemo/v6/csv/wind')
-    overview.set_index('DUID', inplace=True)
-    location = f"{overview.loc[farm,'Lat']},{overview.loc[farm,'Lon']}"
+    farm_info = get_farm(farm)
+    location = f'{farm_info.lat},{farm_info.lon}'
     flags = '?exclude=currently,daily,flags&units=si'
 
     # Set a datetime range, call the api for each day's data in the dt range
     local_dt_range = pd.date_range(local_start_dt, local_end_dt, freq='1D')
+    urls = [f'{DARKSKY_API}/forecast/{DARKSKY_KEY}/{location},'
+            f'{dt.strftime("%Y-%m-%d")}T00:00:00{flags}'
+            for dt in local_dt_range[:-1]]
 
-    weather = pd.DataFrame()
-    for dt in local_dt_range[:-1]:
-        # Construct the API url for each day
-        time = dt.strftime('%Y-%m-%d')+'T00:00:00'
-        dsapi = f'https://api.darksky.net/forecast/{DARKSKY_KEY}/{location},{time}{flags}'
-        with urllib.request.urlopen(dsapi) as url:
-            data = json.loads(url.read().decode())
-        try:
-            df = pd.DataFrame(data['hourly']['data'])
-        except:
-            df = pd.DataFrame()
-        weather = pd.concat([weather, df], axis=0, sort=True)
+    # Fetch the days concurrently, then concat the hourly blocks in one go
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = list(executor.map(fetch_json, urls))
+    hourly = [pd.DataFrame(data.get('hourly', {}).get('data', []))
+              for data in responses]
+    weather = pd.concat(hourly, axis=0, sort=True)
 
     weather['time'] = pd.to_datetime(weather['time'], unit='s')
     weather = weather[['time', 'cloudCover', 'dewPoint', 'humidity', 'ozone', 
@@ -178,12 +441,13 @@ def get_weather(farm, local_start_dt, local_end_dt):
     # make sure there's no missing point in datetime range
     reference_idx = pd.date_range(start=weather.iloc[0].time,
                                   end=weather.iloc[-1].time,
-                                  freq='1H',
+                                  freq='60min',
                                   name='time')
-    weather = weather.set_index('time').reindex(reference_idx).reset_index()
-    weather = fill_val(weather, offset=24)
+    with timer('fill', farm):
+        weather = weather.set_index('time').reindex(
+            reference_idx).reset_index()
+        weather = fill_val(weather, offset=24, chain=3)
 
-    weather.time = weather.time.dt.strftime('%Y-%m-%d %H:%M:%S')
     weather.wind_bearing = weather.wind_bearing.apply(float)
     weather.uv_index = weather.uv_index.apply(float)
 
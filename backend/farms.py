@@ -0,0 +1,121 @@
+"""Registry of the wind farms shown on the dashboard.
+Shared by the backend jobs and the frontend, which ships an identical copy
+as frontend/farms.py, so it only depends on the standard library. Keep the
+two copies in sync.
+"""
+import csv
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import NamedTuple
+
+AREMI_API = os.environ.get('AREMI_API',
+                           'https://services.aremi.data61.io/aemo/v6')
+FARM_SNAPSHOT = os.environ.get(
+    'FARM_SNAPSHOT', os.path.join(tempfile.gettempdir(), 'aremi_wind.csv'))
+OVERVIEW_TTL = 3600
+OUTPUT_COL = 'Current Output (MW)'
+
+FARMS = {'BLUFF1': 'Bluff Wind Farm',
+         'CATHROCK': 'Cathedral Rocks Wind Farm',
+         'CLEMGPWF': 'Clements Gap Wind Farm',
+         'HALLWF2': 'Hallett 2 Wind Farm',
+         'HDWF2': 'Hornsdale Wind Farm 2',
+         'LKBONNY2': 'Lake Bonney Stage 2 Wind Farm',
+         'MTMILLAR': 'Mt Millar Wind Farm',
+         'NBHWF1': 'North Brown Hill Wind Farm',
+         'SNOWNTH1': 'Snowtown Wind Farm Stage 2 North',
+         'SNOWSTH1': 'Snowtown South Wind Farm',
+         'STARHLWF': 'Starfish Hill Wind Farm',
+         'WATERLWF': 'Waterloo Wind Farm',
+         'WPWF': 'Wattle Point Wind Farm'}
+FARM_LIST = list(FARMS.keys())
+FARM_NAME_LIST = list(FARMS.values())
+
+_lock = threading.Lock()
+_cache = {'time': 0.0, 'farms': None}
+
+
+class Farm(NamedTuple):
+    duid: str
+    name: str
+    lat: float
+    lon: float
+    power: float  # current output in MW
+
+
+def _to_float(value):
+    try:
+        return float(value or 0)
+    except ValueError:
+        return 0.0
+
+
+def parse_overview(text):
+    """Parse the AREMI wind overview csv into Farm records by DUID."""
+    reader = csv.reader(text.splitlines())
+    header = next(reader)
+    duid, lat, lon = (header.index(c) for c in ('DUID', 'Lat', 'Lon'))
+    # Only the map shows the output, so it may not stop the jobs: fall back
+    # to the column after the station name, or 0 if that isn't a number
+    output = header.index(OUTPUT_COL) if OUTPUT_COL in header else 1
+
+    farms = dict()
+    for row in reader:
+        if row[duid] in FARMS:
+            farms[row[duid]] = Farm(duid=row[duid],
+                                    name=FARMS[row[duid]],
+                                    lat=float(row[lat]),
+                                    lon=float(row[lon]),
+                                    power=_to_float(row[output]))
+    return farms
+
+
+def _read_snapshot():
+    with open(FARM_SNAPSHOT, encoding='utf-8') as f:
+        return f.read()
+
+
+def _write_snapshot(text):
+    """Write the snapshot atomically so concurrent readers never see half."""
+    tmp = f'{FARM_SNAPSHOT}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, FARM_SNAPSHOT)
+
+
+def load_farms(ttl=OVERVIEW_TTL):
+    """Return Farm records by DUID, from memory or the disk snapshot if they
+    are younger than ttl seconds, otherwise from AREMI. ttl=None accepts
+    any cached copy, which is enough when only coordinates are needed.
+    """
+    with _lock:
+        now = time.time()
+        if _cache['farms'] and (ttl is None or now - _cache['time'] < ttl):
+            return _cache['farms']
+
+        snapshot_time = (os.path.getmtime(FARM_SNAPSHOT)
+                         if os.path.exists(FARM_SNAPSHOT) else None)
+        if snapshot_time and (ttl is None or now - snapshot_time < ttl):
+            text, fetched = _read_snapshot(), snapshot_time
+        else:
+            try:
+                with urllib.request.urlopen(f'{AREMI_API}/csv/wind',
+                                            timeout=30) as response:
+                    text, fetched = response.read().decode('utf-8'), now
+                _write_snapshot(text)
+            except OSError:
+                # Fall back to a stale snapshot rather than failing the run
+                if not snapshot_time:
+                    raise
+                text, fetched = _read_snapshot(), snapshot_time
+
+        _cache.update(time=fetched, farms=parse_overview(text))
+        return _cache['farms']
+
+
+def get_farm(duid, ttl=None):
+    """Return the Farm record of a DUID."""
+    return load_farms(ttl)[duid]
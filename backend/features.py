@@ -0,0 +1,60 @@
+"""Model features of the weather data, shared by training & prediction.
+Only needs numpy & pandas, so the hourly update can build features
+without importing the training dependencies of models.
+"""
+import numpy as np
+import pandas as pd
+
+X_COL = ['cloud_cover', 'dew_point', 'humidity', 'ozone',
+         'precipitation', 'pressure', 'temperature',
+         'uv_index', 'visibility', 'wind_gust', 'wind_speed',
+         'wind_speed_^_2', 'wind_speed_^_3', 'wind_gust_^_2',
+         'wind_gust_^_3', 'sin_wind_bearing', 'cos_wind_bearing']
+WEATHER_COL = ['cloud_cover', 'dew_point', 'humidity', 'ozone',
+               'precipitation', 'pressure', 'temperature', 'uv_index',
+               'visibility', 'wind_bearing', 'wind_gust', 'wind_speed']
+
+
+def transform_data(original_df):
+    """Transform original df to X & y for modelling without copying it.
+    X wraps the float32 feature matrix in a DataFrame with the index of df.
+    """
+    features, columns = build_features(original_df)
+    X = pd.DataFrame(features, columns=columns, index=original_df.index,
+                     copy=False)
+
+    if 'actual' in original_df.columns:
+        y = original_df.actual
+    else:
+        y = None
+
+    return X, y
+
+
+def build_features(df, out=None):
+    """Write the X_COL features of df into out, a float32 array of shape
+    (len(df), len(X_COL)), which is allocated if not given.
+    Returns out & the column names, ready for a DMatrix.
+    """
+    if out is None:
+        out = np.empty((len(df), len(X_COL)), dtype='float32')
+    n_raw = X_COL.index('wind_speed') + 1
+    for i, col in enumerate(X_COL[:n_raw]):
+        out[:, i] = df[col].values
+
+    for i, col in [(n_raw, 'wind_speed'), (n_raw+2, 'wind_gust')]:
+        base = out[:, X_COL.index(col)]
+        np.multiply(base, base, out=out[:, i])
+        np.multiply(out[:, i], base, out=out[:, i+1])
+    bearing = np.radians(df['wind_bearing'].values)
+    out[:, n_raw+4] = np.sin(bearing)
+    out[:, n_raw+5] = np.cos(bearing)
+
+    return out, X_COL
+
+
+def weather_hash(df):
+    """Hash the weather fields of each row to tell when they changed."""
+    hashes = pd.util.hash_pandas_object(
+        df[WEATHER_COL].astype('float64'), index=False)
+    return pd.Series(hashes.values.view('int64'), index=df.index)
@@ -0,0 +1,163 @@
+"""Per-invocation stage timers & counters for the backend jobs.
+
+Stages are timed with the timer context manager or the timed decorator,
+counters are bumped with count, both optionally by farm. emit prints
+everything recorded since reset as one CloudWatch embedded metric format
+(EMF) record: totals become metrics, the per farm breakdown a property.
+Thread safe, worker processes send their snapshot back to be merged.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WindDashboard')
+COUNTERS = {'rows_fetched': 'Count', 'rows_written': 'Count',
+            'http_calls': 'Count', 'http_bytes': 'Bytes',
+            'mongo_round_trips': 'Count', 'trials': 'Count'}
+PROFILE_LINES = 30
+
+_lock = threading.Lock()
+_timers = dict()  # (stage, farm) -> [calls, seconds]
+_counters = dict()  # (name, farm) -> value
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def record(stage, seconds, farm=None):
+    with _lock:
+        calls = _timers.setdefault((stage, farm), [0, 0.0])
+        calls[0] += 1
+        calls[1] += seconds
+
+
+def count(name, value=1, farm=None):
+    with _lock:
+        _counters[(name, farm)] = _counters.get((name, farm), 0) + value
+
+
+@contextmanager
+def timer(stage, farm=None):
+    """Time the block as stage of farm."""
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - time_start, farm)
+
+
+def timed(stage):
+    """Decorator timing every call of a function as stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Return what was recorded so far, to merge into another process."""
+    with _lock:
+        return {'timers': {k: list(v) for k, v in _timers.items()},
+                'counters': dict(_counters)}
+
+
+def merge(snap):
+    with _lock:
+        for key, (calls, seconds) in snap['timers'].items():
+            total = _timers.setdefault(key, [0, 0.0])
+            total[0] += calls
+            total[1] += seconds
+        for key, value in snap['counters'].items():
+            _counters[key] = _counters.get(key, 0) + value
+
+
+def emit(action, runtime, **properties):
+    """Print & return the EMF record of everything recorded since reset.
+    Each stage gives a <stage>_ms total & <stage>_calls metric, each
+    counter its total, the Farms property breaks them down by farm.
+    """
+    snap = snapshot()
+    values, units, farms = dict(), dict(), dict()
+    for (stage, farm), (calls, seconds) in snap['timers'].items():
+        for name, value, unit in [(f'{stage}_ms', seconds * 1000,
+                                   'Milliseconds'),
+                                  (f'{stage}_calls', calls, 'Count')]:
+            values[name] = values.get(name, 0) + value
+            units[name] = unit
+            if farm is not None:
+                farm_values = farms.setdefault(farm, dict())
+                farm_values[name] = farm_values.get(name, 0) + value
+    for (name, farm), value in snap['counters'].items():
+        values[name] = values.get(name, 0) + value
+        units[name] = COUNTERS.get(name, 'Count')
+        if farm is not None:
+            farm_values = farms.setdefault(farm, dict())
+            farm_values[name] = farm_values.get(name, 0) + value
+    values['runtime_ms'] = runtime * 1000
+    units['runtime_ms'] = 'Milliseconds'
+
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Action']],
+                'Metrics': [{'Name': name, 'Unit': unit}
+                            for name, unit in sorted(units.items())],
+            }],
+        },
+        'Action': action,
+        **{name: round(value, 3) for name, value in values.items()},
+        'Farms': {farm: {name: round(value, 3)
+                         for name, value in farm_values.items()}
+                  for farm, farm_values in sorted(farms.items())},
+        **properties,
+    }
+    print(json.dumps(record))
+    return record
+
+
+@contextmanager
+def profile(kind=None):
+    """Profile the block with 'cprofile' or 'pyinstrument' & print the
+    hottest calls, do nothing if kind is None.
+    """
+    if kind is None:
+        yield
+        return
+    if kind == 'pyinstrument':
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            print(profiler.output_text())
+        return
+    if kind != 'cprofile':
+        raise ValueError(f'unknown profiler {kind!r}')
+    import cProfile
+    import io
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(
+            'cumulative').print_stats(PROFILE_LINES)
+        print(out.getvalue())
@@ -0,0 +1,117 @@
+"""Per-farm model store.
+Each farm's booster is saved as models/<farm>.ubj in XGBoost's UBJSON
+format, and models/manifest.json lists the version, training range and
+checksum of each. Boosters are loaded on first use and kept in memory,
+so warm starts reuse them.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from xgboost import Booster
+
+MODEL_DIR = 'models'
+MANIFEST_FILE = os.path.join(MODEL_DIR, 'manifest.json')
+
+_lock = threading.Lock()
+_boosters = dict()
+
+
+def model_path(farm):
+    return os.path.join(MODEL_DIR, f'{farm}.ubj')
+
+
+def checksum(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return dict()
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+
+def _replace_json(obj, path):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def save_model(farm, model, dt_range):
+    """Save the booster of a model (or a Booster) & add it to the manifest.
+    Both files are replaced atomically.
+    """
+    booster = model
+    if hasattr(model, 'get_booster'):
+        booster = model.get_booster()
+        # XGBRegressor.predict stops at the best iteration of early stopping,
+        # keep only those trees so inplace_predict gives the same result
+        best_iteration = getattr(model, 'best_iteration', None)
+        if best_iteration is not None:
+            booster = booster[:best_iteration+1]
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    # XGBoost picks the format from the extension, so keep .ubj last
+    tmp = os.path.join(MODEL_DIR, f'{farm}.tmp.ubj')
+    booster.save_model(tmp)
+    digest = checksum(tmp)
+    os.replace(tmp, model_path(farm))
+
+    with _lock:
+        manifest = read_manifest()
+        manifest[farm] = {'version': digest[:12],
+                          'dt_range': dt_range,
+                          'checksum': digest,
+                          'trained_at': int(time.time())}
+        _replace_json(manifest, MANIFEST_FILE)
+        _boosters[farm] = (digest[:12], booster)
+
+
+def model_version(farm):
+    """Version of the farm's current model, stored with its predictions."""
+    return read_manifest()[farm]['version']
+
+
+def load_model(farm):
+    """Return the Booster of a farm, loading it on first use."""
+    with _lock:
+        manifest = read_manifest()
+        version = manifest[farm]['version']
+        if farm in _boosters and _boosters[farm][0] == version:
+            return _boosters[farm][1]
+
+        path = model_path(farm)
+        if checksum(path) != manifest[farm]['checksum']:
+            raise ValueError(f'Checksum mismatch for {path}')
+        booster = Booster()
+        booster.load_model(path)
+        _boosters[farm] = (version, booster)
+        return booster
+
+
+def import_pickle(pickle_file, train_log_file=os.path.join(MODEL_DIR,
+                                                            'train.log')):
+    """Convert a models.pkl.gz dict of XGBRegressors to the store, taking
+    each training range from the last train log row of the farm.
+    """
+    import csv
+    from compress_pickle import load
+
+    dt_ranges = dict()
+    if os.path.exists(train_log_file):
+        with open(train_log_file) as csvfile:
+            for row in csv.DictReader(csvfile, delimiter='\t'):
+                dt_ranges[row['model_name']] = row['dt_range_UTC']
+
+    models = load(open(pickle_file, 'rb'), compression='gzip')
+    for farm, model in models.items():
+        save_model(farm, model, dt_ranges.get(farm))
+        print(f'Imported {farm}')
+
+
+if __name__ == '__main__':
+    import_pickle(os.path.join(MODEL_DIR, 'models.pkl.gz'))
@@ -1,21 +1,32 @@
+import ast
 import csv
+import json
 import os
 import time
 import uuid
-from compress_pickle import dump as dump_pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from random import randint
 
 import numpy as np
-import pandas as pd
-from hyperopt import STATUS_OK, Trials, fmin, hp, tpe
-from xgboost import XGBRegressor
+import xgboost as xgb
+from hyperopt import JOB_STATE_DONE, STATUS_OK, Trials, fmin, hp, tpe
 
-from data import fetch_data, connect_db
+from data import fetch_data, get_client
+from features import WEATHER_COL, transform_data
+from metrics import count, merge, reset, snapshot, timer
+from model_store import load_model, read_manifest, save_model
 
-MODEL_FILE = os.path.join('models', 'models.pkl.gz')
 TRAIN_LOG_FILE = os.path.join('models', 'train.log')
-MONGO_URI = os.environ.get('MONGO_URI')
-
+TRIALS_DIR = os.path.join('models', 'trials')
+MAX_HISTORY = 500
+WARM_EVALS = 20
+DATA_SOURCE = os.environ.get('DATA_SOURCE', 'mongo')
+# Lambda has no /dev/shm for process pools, so farms train one at a time
+IN_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+HOLDOUT_HOURS = 7 * 24
+UPDATE_ROUNDS = 20
+RMSE_THRESHOLD = 0.1
 seed = randint(0, 10000)
 space = {'max_depth': hp.quniform('max_depth', 3, 15, 1),
          'gamma': hp.uniform('gamma', 1, 9),
@@ -34,10 +45,15 @@ def mse(y_true, y_pred, squared=True):
     return np.average(output_errors)
 
 
-def split_data(X, y, seed, test_size=0.1, val_size=0.1):
-    indexes = X.index.values.copy()
-    rng = np.random.default_rng(seed)
-    rng.shuffle(indexes)
+def split_data(X, y, seed, test_size=0.1, val_size=0.1, mode='shuffle'):
+    """Split X & y into train, val & test sets. 'shuffle' splits the rows
+    at random, 'block' splits X in time order into contiguous blocks so
+    autocorrelated hours don't leak between the sets.
+    """
+    indexes = np.arange(len(X))
+    if mode == 'shuffle':
+        rng = np.random.default_rng(seed)
+        rng.shuffle(indexes)
 
     n_train = int(len(X) * (1 - test_size - val_size))
     n_val = int(len(X) * val_size)
@@ -45,94 +61,252 @@ def split_data(X, y, seed, test_size=0.1, val_size=0.1):
     val = indexes[n_train: n_train+n_val]
     test = indexes[n_train+n_val:]
 
-    return X.loc[train, :], X.loc[val, :], X.loc[test, :], y.loc[train], y.loc[val], y.loc[test]
-
-
-def transform_data(original_df):
-    """Add features and transform original df to X & y for modelling."""
-    X_COL = ['cloud_cover', 'dew_point', 'humidity', 'ozone',
-             'precipitation', 'pressure', 'temperature',
-             'uv_index', 'visibility', 'wind_gust', 'wind_speed',
-             'wind_speed_^_2', 'wind_speed_^_3', 'wind_gust_^_2',
-             'wind_gust_^_3', 'sin_wind_bearing', 'cos_wind_bearing']
-
-    df = original_df.copy(deep=True)
-
-    df['time'] = pd.to_datetime(df['time'], utc=True)
-    df['wind_speed_^_2'] = df['wind_speed']**2
-    df['wind_speed_^_3'] = df['wind_speed']**3
-    df['wind_gust_^_2'] = df['wind_gust']**2
-    df['wind_gust_^_3'] = df['wind_gust']**3
-    df['sin_wind_bearing'] = np.sin(df['wind_bearing'] * np.pi / 180.)
-    df['cos_wind_bearing'] = np.cos(df['wind_bearing'] * np.pi / 180.)
-
-    X = df[X_COL]
+    return X.iloc[train], X.iloc[val], X.iloc[test], y.iloc[train], y.iloc[val], y.iloc[test]
 
-    if 'actual' in df.columns:
-        y = df.actual
-    else:
-        y = None
-
-    return X, y
 
+def make_dmatrix(X, y, ref=None):
+    """Build a QuantileDMatrix where XGBoost has it, else a DMatrix.
+    Either way the data is only quantized once, however often it's used.
+    """
+    if hasattr(xgb, 'QuantileDMatrix'):
+        return xgb.QuantileDMatrix(X, y, ref=ref)
+    return xgb.DMatrix(X, y)
 
-def best_model_from_trials(trials):
-    """Extract and return the best model object from trails."""
-    valid_trial_list = [trial for trial in trials
-                        if STATUS_OK == trial['result']['status']]
-    losses = [float(trial['result']['loss']) for trial in valid_trial_list]
-    index_having_minimum_loss = np.argmin(losses)
-    best_trial_obj = valid_trial_list[index_having_minimum_loss]
 
-    return best_trial_obj['result']['model']
+def trials_file(farm):
+    return os.path.join(TRIALS_DIR, f'{farm}.json')
 
 
-def optimize_model(farm, max_evals, timeout):
-    """Use Hyperopt to optimize hyperparams, return best model."""
+def load_trials(farm):
+    """Return Trials seeded with the saved trial history of a farm, so TPE
+    starts from what earlier searches learned. The losses were measured on
+    older data, which is fine for guiding the search.
+    """
+    trials = Trials()
+    if not os.path.exists(trials_file(farm)):
+        return trials
+    with open(trials_file(farm)) as f:
+        history = json.load(f)
+
+    tids = trials.new_trial_ids(len(history))
+    results = [{'loss': h['loss'], 'status': STATUS_OK} for h in history]
+    miscs = [{'tid': tid,
+              'cmd': ('domain_attachment', 'FMinIter_Domain'),
+              'workdir': None,
+              'idxs': {label: [tid] for label in h['vals']},
+              'vals': {label: [v] for label, v in h['vals'].items()}}
+             for tid, h in zip(tids, history)]
+    docs = trials.new_trial_docs(tids, [None] * len(history), results, miscs)
+    for doc in docs:
+        doc['state'] = JOB_STATE_DONE
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+    return trials
+
+
+def save_trials(farm, trials):
+    """Save the params & loss of the last MAX_HISTORY trials of a farm."""
+    history = [{'vals': {label: float(v[0])
+                         for label, v in t['misc']['vals'].items()},
+                'loss': float(t['result']['loss'])}
+               for t in trials.trials if t['result']['status'] == STATUS_OK]
+    os.makedirs(TRIALS_DIR, exist_ok=True)
+    tmp = f'{trials_file(farm)}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history[-MAX_HISTORY:], f)
+    os.replace(tmp, trials_file(farm))
+
+
+def xgb_params(space, n_jobs=None):
+    """Map a point of the search space to XGBoost training params."""
+    return {'objective': 'reg:squarederror',
+            'eval_metric': 'rmse',
+            'tree_method': 'hist',
+            'max_depth': int(space['max_depth']),
+            'gamma': space['gamma'],
+            'alpha': int(space['reg_alpha']),
+            'min_child_weight': space['min_child_weight'],
+            'colsample_bytree': space['colsample_bytree'],
+            'seed': seed,
+            'nthread': n_jobs}
+
+
+def optimize_model(farm, max_evals, timeout, n_jobs=None,
+                   split_mode='shuffle', warm_evals=WARM_EVALS):
+    """Use Hyperopt to optimize hyperparams, seeded with the saved trials
+    of the farm. Runs max_evals new trials, or at most warm_evals if there
+    was a saved history. Return best model and its row for the train log.
+    """
     time_start = time.time()
     # ingest data
-    client = connect_db(MONGO_URI)
-    df = fetch_data(client, farm, limit=None)
+    client = get_client()
+    df = fetch_data(client, farm, limit=None, fields=WEATHER_COL + ['actual'],
+                    columnar=True, source=DATA_SOURCE)
     df.dropna(inplace=True)
-    X, y = transform_data(df)
+    df.sort_values('time', inplace=True)
+    with timer('transform', farm):
+        X, y = transform_data(df)
     X_train, X_val, X_test, y_train, y_val, y_test = split_data(
-        X, y, seed=seed)
+        X, y, seed=seed, mode=split_mode)
+
+    # Build the matrices once, every trial reuses them
+    dtrain = make_dmatrix(X_train, y_train)
+    dval = make_dmatrix(X_val, y_val, ref=dtrain)
+    dtest = xgb.DMatrix(X_test)
+
+    # Only the best model so far is kept, not one per trial
+    best = {'loss': np.inf, 'model': None, 'space': None}
 
     # tune paramaters
     def objective(space):
         """Define Hyperopt objectives to minimize MSE."""
-        model = XGBRegressor(n_estimators=int(space['n_estimators']),
-                             max_depth=int(space['max_depth']),
-                             gamma=space['gamma'],
-                             reg_alpha=int(space['reg_alpha']),
-                             min_child_weight=space['min_child_weight'],
-                             colsample_bytree=space['colsample_bytree'],
-                             eval_metric='rmse',
-                             early_stopping_rounds=5,
-                             random_state=seed)
-
-        model.fit(X_train, y_train,
-                  eval_set=[(X_train, y_train), (X_val, y_val)],
-                  verbose=False)
-
-        pred = model.predict(X_val)
-        return {'loss': mse(y_val, pred), 'status': STATUS_OK, 'model': model}
-
-    trials = Trials()
-    best = fmin(fn=objective,
-                space=space,
-                algo=tpe.suggest,
-                max_evals=max_evals,
-                trials=trials,
-                timeout=timeout)
-    model = best_model_from_trials(trials)
+        with timer('trial', farm):
+            model = xgb.train(xgb_params(space, n_jobs), dtrain,
+                              num_boost_round=int(space['n_estimators']),
+                              evals=[(dtrain, 'train'), (dval, 'val')],
+                              early_stopping_rounds=5,
+                              verbose_eval=False)
+            # Keep only the trees up to the best iteration
+            model = model[:model.best_iteration+1]
+
+            loss = mse(y_val, model.predict(dval))
+        count('trials', 1, farm)
+        if loss < best['loss']:
+            best.update(loss=loss, model=model,
+                        space={k: float(v) for k, v in space.items()})
+        return {'loss': loss, 'status': STATUS_OK}
+
+    trials = load_trials(farm)
+    n_seeded = len(trials.trials)
+    if n_seeded and warm_evals is not None:
+        max_evals = min(max_evals, warm_evals)
+    fmin(fn=objective,
+         space=space,
+         algo=tpe.suggest,
+         max_evals=n_seeded + max_evals,
+         trials=trials,
+         timeout=timeout)
+    save_trials(farm, trials)
+    model = best['model']
 
     # logging
     m, s = divmod(time.time()-time_start, 60)
     h, m = divmod(m, 60)
     runtime = '%03d:%02d:%02d' % (h, m, s)
     dt_range = f'{df.time.iloc[0]}~{df.time.iloc[-1]}'
-    trial_no = len(trials.trials)
+    trial_no = len(trials.trials) - n_seeded
+    log_row = [
+        uuid.uuid4(),
+        int(time.time()),
+        farm,
+        runtime,
+        trial_no,
+        dt_range,
+        best['space'],
+        mse(model.predict(dtest), y_test, squared=False),
+        seed,
+    ]
+
+    return model, log_row
+
+
+def update_model(farm, n_jobs=None, holdout_hours=HOLDOUT_HOURS,
+                 rounds=UPDATE_ROUNDS):
+    """Continue boosting the current model of a farm with its last best
+    params on the rows added since it was trained. The last holdout_hours
+    rows are held out to check the update, and the better of the updated &
+    current model is kept. The trained range only moves forward if the
+    update is kept, so rejected rows are used again by the next update.
+    Returns the model and its row for the train log, or None if there
+    aren't enough new rows.
+    """
+    time_start = time.time()
+    trained_from, trained_until = sorted(
+        read_manifest()[farm]['dt_range'].split('~'))
+    best = ast.literal_eval(read_train_log(farm)[-1]['best_param'])
+
+    client = get_client()
+    df = fetch_data(client, farm, limit=None, fields=WEATHER_COL + ['actual'],
+                    start=trained_until, columnar=True, source=DATA_SOURCE)
+    df = df[df.time > trained_until].dropna().sort_values('time')
+    if len(df) <= holdout_hours:
+        return None
+    with timer('transform', farm):
+        X, y = transform_data(df)
+    n_update = len(df) - holdout_hours
+    dupdate = make_dmatrix(X.iloc[:n_update], y.iloc[:n_update])
+    dholdout = xgb.DMatrix(X.iloc[n_update:])
+    y_holdout = y.iloc[n_update:]
+
+    current = load_model(farm)
+    updated = xgb.train(xgb_params(best, n_jobs), dupdate,
+                        num_boost_round=rounds, xgb_model=current)
+    rmse = {model: mse(y_holdout, model.predict(dholdout), squared=False)
+            for model in (current, updated)}
+    model = min(rmse, key=rmse.get)
+
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    runtime = '%03d:%02d:%02d' % (h, m, s)
+    if model is updated:
+        dt_range = f'{trained_from}~{df.time.iloc[n_update-1]}'
+    else:
+        dt_range = f'{trained_from}~{trained_until}'
+    log_row = [
+        uuid.uuid4(),
+        int(time.time()),
+        farm,
+        runtime,
+        0,
+        dt_range,
+        best,
+        rmse[model],
+        seed,
+    ]
+
+    return model, log_row
+
+
+def train_farm(farm, max_evals, timeout, n_jobs=None, split_mode='shuffle',
+               incremental=False, warm_evals=WARM_EVALS):
+    """Train the model of a farm. In incremental mode the current model is
+    updated, and the full search only runs if there is no model yet or its
+    holdout RMSE is more than RMSE_THRESHOLD worse than the test RMSE of
+    the last search. Returns the model & its train log row, or None if
+    there's nothing to update.
+    """
+    searches = [row for row in read_train_log(farm) if row['trials'] != '0']
+    if incremental and searches and farm in read_manifest():
+        result = update_model(farm, n_jobs)
+        if result is None:
+            return None
+        limit = float(searches[-1]['test_rmse']) * (1 + RMSE_THRESHOLD)
+        if result[1][7] <= limit:
+            return result
+        print(f'Holdout RMSE of {farm} went up to {result[1][7]:.3f}, '
+              'running the full search')
+
+    return optimize_model(farm, max_evals, timeout, n_jobs, split_mode,
+                          warm_evals)
+
+
+def train_farm_worker(*args):
+    """Run train_farm in a worker process, return its result & metrics."""
+    reset()
+    return train_farm(*args), snapshot()
+
+
+def read_train_log(farm):
+    """Return the train log rows of a farm as dicts, oldest first."""
+    if not os.path.exists(TRAIN_LOG_FILE):
+        return []
+    with open(TRAIN_LOG_FILE) as csvfile:
+        return [row for row in csv.DictReader(csvfile, delimiter='\t')
+                if row['model_name'] == farm]
+
+
+def write_train_log(log_row):
+    """Append a row to the train log, writing the header to a new log."""
     header = ['unique_id', 'timestamp', 'model_name', 'runtime', 'trials',
               'dt_range_UTC', 'best_param', 'test_rmse', 'seed']
     write_header = False
@@ -142,33 +316,78 @@ def optimize_model(farm, max_evals, timeout):
         writer = csv.writer(csvfile, delimiter='\t')
         if write_header:
             writer.writerow(header)
-        to_write = map(str, [
-            uuid.uuid4(),
-            int(time.time()),
-            farm,
-            runtime,
-            trial_no,
-            dt_range,
-            best,
-            mse(model.predict(X_test), y_test, squared=False),
-            seed,
-        ])
-        writer.writerow(to_write)
-
-    return model
-
-
-def train_models(train_list, max_evals=50, timeout=300, dump=True):
-    """Train models for all farms, returns a dict of all model objects."""
+        writer.writerow(map(str, log_row))
+
+
+def is_up_to_date(client, farm):
+    """Check if the model of a farm was trained on the latest data."""
+    dt_range = read_manifest().get(farm, {}).get('dt_range')
+    if not dt_range:
+        return False
+    trained_until = max(dt_range.split('~'))
+
+    latest = client['wpp'][farm].find_one(
+        {'actual': {'$ne': None}}, {'_id': 1}, sort=[('_id', -1)])
+    return latest is None or latest['_id'] <= trained_until
+
+
+def train_models(train_list, max_evals=50, timeout=300, dump=True,
+                 n_workers=None, resume=False, split_mode='shuffle',
+                 incremental=False, warm_evals=WARM_EVALS):
+    """Train models for all farms in a pool of n_workers processes, one
+    per core by default, or one after another in Lambda. Returns a dict
+    of the trained model objects. Each model & train log row is saved as
+    soon as its farm is done. With resume, farms whose model was trained
+    on the latest data are skipped. See train_farm for the incremental
+    mode. Searches of farms with saved trials run at most
+    warm_evals trials, see optimize_model.
+    """
     models = dict()
-
-    for farm in train_list:
-        model = optimize_model(farm, max_evals=max_evals, timeout=timeout)
+    if resume:
+        client = get_client()
+        train_list = [farm for farm in train_list
+                      if not is_up_to_date(client, farm)]
+        print(f'Resuming, {len(train_list)} farms to train')
+    if not train_list:
+        return models
+
+    # Split the cores between workers so XGBoost doesn't oversubscribe them
+    if n_workers is None:
+        n_workers = 1 if IN_LAMBDA else os.cpu_count()
+    n_workers = min(n_workers, len(train_list))
+    n_jobs = max(1, os.cpu_count() // n_workers)
+
+    def save(farm, result):
+        if result is None:
+            print(f'Not enough new data for {farm}, skipped')
+            return
+        model, log_row = result
         models[farm] = model
-
-    if dump:
-        print('Dumping file...', end='', flush=True)
-        dump_pickle(models, open(MODEL_FILE, 'wb'))
-        print(' Done!')
+        write_train_log(log_row)
+        if dump:
+            save_model(farm, model, dt_range=log_row[5])
+        print(f'Trained {farm}, test RMSE {log_row[7]:.3f}')
+
+    if n_workers == 1:
+        for farm in train_list:
+            save(farm, train_farm(farm, max_evals, timeout, n_jobs,
+                                  split_mode, incremental, warm_evals))
+        return models
+
+    # Spawn rather than fork, MongoClient isn't fork-safe
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=get_context('spawn')) as executor:
+        futures = {executor.submit(train_farm_worker, farm, max_evals,
+                                   timeout, n_jobs, split_mode, incremental,
+                                   warm_evals): farm
+                   for farm in train_list}
+        for future in as_completed(futures):
+            farm = futures[future]
+            try:
+                result, worker_metrics = future.result()
+                merge(worker_metrics)
+                save(farm, result)
+            except Exception as e:
+                print(f'Failed to train {farm}: {e!r}')
 
     return models
@@ -0,0 +1,95 @@
+"""Local columnar cache of the farm collections.
+Each farm is mirrored to CACHE_DIR/<farm>/<YYYY-MM>.parquet. A sync only
+pulls documents from the last cached hour on, minus SYNC_OVERLAP since
+recent hours still get their forecasts & actuals updated. Predictions,
+model versions & weather hashes are not cached, update_pred rewrites them
+over the whole history whenever a model changes.
+For local training runs only, pyarrow is not in the Lambda image:
+pip install -r requirements-cache.txt
+"""
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data import fetch_data, to_id
+from features import WEATHER_COL
+
+CACHE_DIR = os.environ.get('CACHE_DIR', 'cache')
+CACHE_COL = WEATHER_COL + ['icon', 'actual']
+SYNC_OVERLAP = pd.Timedelta(days=3)
+
+
+def month_files(farm):
+    """Return the cached month files of a farm, oldest first."""
+    path = os.path.join(CACHE_DIR, farm)
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, f) for f in sorted(os.listdir(path))
+            if f.endswith('.parquet')]
+
+
+def read_month(path, fields=None):
+    """Read a month file memory-mapped, skipping fields it doesn't have."""
+    if fields is not None:
+        names = pq.read_schema(path).names
+        fields = ['time'] + [f for f in fields if f in names]
+    return pq.read_table(path, columns=fields,
+                         memory_map=True).to_pandas()
+
+
+def write_month(df, path):
+    tmp = f'{path}.tmp'
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp)
+    os.replace(tmp, path)
+
+
+def last_cached(farm):
+    """Return the last cached _id of a farm, or None if it's not cached."""
+    files = month_files(farm)
+    if not files:
+        return None
+    return read_month(files[-1], fields=[])['time'].max()
+
+
+def sync_farm(client, farm):
+    """Pull new documents of a farm into the cache, return their count."""
+    last = last_cached(farm)
+    start = None if last is None else pd.Timestamp(last) - SYNC_OVERLAP
+    df = fetch_data(client, farm, fields=CACHE_COL, start=start,
+                    columnar=True)
+    if len(df) == 0:
+        return 0
+
+    os.makedirs(os.path.join(CACHE_DIR, farm), exist_ok=True)
+    for month, part in df.groupby(df['time'].str[:7]):
+        path = os.path.join(CACHE_DIR, farm, f'{month}.parquet')
+        if os.path.exists(path):
+            cached = read_month(path, CACHE_COL)
+            part = pd.concat([cached[~cached['time'].isin(part['time'])],
+                              part])
+        write_month(part.sort_values('time'), path)
+    return len(df)
+
+
+def read_farm(farm, fields=None, start=None, end=None, limit=None):
+    """Read a farm from the cache like fetch_data does from the database:
+    newest first, with the last limit rows in the time range.
+    """
+    start = to_id(start) if start is not None else None
+    end = to_id(end) if end is not None else None
+    # Only open the month files overlapping the time range
+    files = [f for f in month_files(farm)
+             if (start is None or os.path.basename(f)[:7] >= start[:7])
+             and (end is None or os.path.basename(f)[:7] <= end[:7])]
+    if not files:
+        return pd.DataFrame(columns=['time'] + (fields or []))
+
+    df = pd.concat([read_month(f, fields) for f in files], ignore_index=True)
+    if start is not None:
+        df = df[df['time'] >= start]
+    if end is not None:
+        df = df[df['time'] < end]
+    df = df.iloc[::-1].reset_index(drop=True)
+    return df.head(limit) if limit else df
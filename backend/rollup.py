@@ -0,0 +1,51 @@
+"""Daily & weekly rollups of the farm collections for long dashboard ranges.
+Rollups are stored in <farm>_daily & <farm>_weekly, keyed by the UTC time
+of the local (Australia/Sydney) start of the day or week, with the mean,
+min & max of each of ROLLUP_COL.
+"""
+import pandas as pd
+
+from data import fetch_data, update_db
+
+TZ = 'Australia/Sydney'
+ROLLUP_COL = ['actual', 'prediction', 'wind_speed', 'wind_gust',
+              'temperature']
+PERIODS = ['daily', 'weekly']
+
+
+def period_start(times, period):
+    """Local start of the day or week (from Monday) of tz-aware times."""
+    days = times.dt.normalize()
+    if period == 'weekly':
+        days = days - pd.to_timedelta(times.dt.dayofweek, unit='D')
+    return days
+
+
+def rollup(df, period):
+    """Aggregate hourly rows to one row per period."""
+    times = pd.to_datetime(df['time'], utc=True).dt.tz_convert(TZ)
+    key = period_start(times, period).dt.tz_convert('UTC')
+    stats = df[ROLLUP_COL].groupby(key.values).agg(['mean', 'min', 'max'])
+    stats.columns = [f'{col}_{stat}' for col, stat in stats.columns]
+    stats.index = pd.DatetimeIndex(stats.index).strftime('%Y-%m-%d %H:%M:%S')
+    return stats.rename_axis('time').reset_index()
+
+
+def update_rollups(client, farm, local_start_dt=None, local_end_dt=None):
+    """Recompute the rollups of every day & week touched by the local
+    range, or of the whole history if no range is given.
+    """
+    start, end = None, None
+    if local_start_dt is not None:
+        start = period_start(pd.Series(
+            pd.to_datetime([local_start_dt]).tz_localize(TZ)), 'weekly')[0]
+    if local_end_dt is not None:
+        end = pd.Timestamp(local_end_dt, tz=TZ).normalize() \
+            + pd.Timedelta(days=1)
+
+    df = fetch_data(client, farm, fields=ROLLUP_COL, start=start, end=end,
+                    columnar=True)
+    if len(df) == 0:
+        return
+    for period in PERIODS:
+        update_db(f'{farm}_{period}', rollup(df, period), client=client)
@@ -1,9 +1,16 @@
+import os
+
 from models import train_models
 from data import FARM_LIST
 
+# Defaults to one worker in Lambda & one per core elsewhere
+TRAIN_WORKERS = os.environ.get('TRAIN_WORKERS')
+
 
-def retrain_models():
-    models = train_models(FARM_LIST)
+def retrain_models(resume=False, incremental=False):
+    n_workers = int(TRAIN_WORKERS) if TRAIN_WORKERS else None
+    models = train_models(FARM_LIST, n_workers=n_workers, resume=resume,
+                          incremental=incremental)
     return models
 
 if __name__ == '__main__':
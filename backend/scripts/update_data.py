@@ -1,44 +1,165 @@
 import os
-from compress_pickle import load
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import arrow
 import pandas as pd
 import numpy as np
 
-from models import MODEL_FILE, transform_data
-from data import FARM_LIST, update_db, get_weather, get_power
+from features import X_COL, build_features, weather_hash
+from metrics import record, timer
+from model_store import load_model, model_version
+from rollup import update_rollups
+from data import (FARM_LIST, update_db, get_client, mark_update, get_weather,
+                  get_power)
 pd.options.mode.chained_assignment = None
 
-MONGO_URI = os.environ['MONGO_URI']
+MAX_FARMS = int(os.environ.get('MAX_FARMS', 4))
+STAGES = ['weather', 'power', 'predict', 'merge', 'write', 'rollup']
 
 
-def update_data():
+def timed(farm, timings, stage, func, *args, **kwargs):
+    """Call func and record its runtime in timings & the metrics of farm
+    under stage.
+    """
     time_start = time.time()
-    models = load(open(MODEL_FILE, 'rb'))
+    result = func(*args, **kwargs)
+    timings[stage] = time.time()-time_start
+    record(stage, timings[stage], farm)
+    return result
+
+
+def fetch_farm(farm, yesterday, today, dayafter, timings):
+    """Fetch the weather & power updates of one farm concurrently."""
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        weather = executor.submit(timed, farm, timings, 'weather',
+                                  get_weather, farm, yesterday, dayafter)
+        power = executor.submit(timed, farm, timings, 'power', get_power,
+                                farm, yesterday, today)
+        return weather.result(), power.result()
+
+
+def predict_farms(weather_updates, report):
+    """Predict all farms from one float32 feature matrix, each model on
+    its own slice. Farms whose prediction fails are dropped.
+    """
+    farms = list(weather_updates)
+    bounds = np.cumsum([0] + [len(weather_updates[f]) for f in farms])
+    X = np.empty((bounds[-1], len(X_COL)), dtype='float32')
+    pred = np.full(bounds[-1], np.nan, dtype='float32')
+    for farm, start, end in zip(farms, bounds[:-1], bounds[1:]):
+        with timer('transform', farm):
+            build_features(weather_updates[farm], out=X[start:end])
+
+    for farm, start, end in zip(farms, bounds[:-1], bounds[1:]):
+        try:
+            time_start = time.time()
+            pred[start:end] = load_model(farm).inplace_predict(
+                X[start:end], validate_features=False)
+            report[farm]['predict'] = time.time()-time_start
+            record('predict', report[farm]['predict'], farm)
+        except Exception as e:
+            print(f'Failed to predict {farm}: {e!r}')
+            report[farm] = {'error': repr(e)}
+    np.clip(pred, 0.0, None, out=pred)
+
+    for farm, start, end in zip(farms, bounds[:-1], bounds[1:]):
+        if 'error' in report[farm]:
+            del weather_updates[farm]
+            continue
+        weather_update = weather_updates[farm]
+        weather_update['prediction'] = pred[start:end]
+        weather_update['model_version'] = model_version(farm)
+        weather_update['weather_hash'] = weather_hash(weather_update)
+
+
+def merge_updates(weather_update, power_update):
+    """Outer join the weather & prediction with the actual power by hour,
+    so each hour is one document.
+    """
+    return pd.merge(weather_update, power_update, on='time', how='outer',
+                    sort=True)
+
+
+def write_farm(farm, client, weather_update, power_update, yesterday,
+               dayafter, timings):
+    """Write the updates of one farm in one bulk write, only setting the
+    fields that changed, then its rollups.
+    """
+    update = timed(farm, timings, 'merge', merge_updates, weather_update,
+                   power_update)
+    timed(farm, timings, 'write', update_db, farm, update, upsert=True,
+          client=client, changed_only=True)
+    timed(farm, timings, 'rollup', update_rollups, client, farm, yesterday,
+          dayafter)
+
+
+def run_farms(func, jobs, max_farms, report):
+    """Run func(farm, *args, timings) for each farm & args in jobs in a
+    thread pool. A failed farm is reported and doesn't stop the others.
+    Returns the results by farm.
+    """
+    results = dict()
+    with ThreadPoolExecutor(max_workers=max_farms) as executor:
+        futures = {executor.submit(func, farm, *args, report[farm]): farm
+                   for farm, args in jobs.items()}
+        for future in as_completed(futures):
+            farm = futures[future]
+            try:
+                results[farm] = future.result()
+            except Exception as e:
+                print(f'Failed to update {farm}: {e!r}')
+                report[farm] = {'error': repr(e)}
+    return results
+
+
+def update_data(max_farms=MAX_FARMS):
+    """Update all farms: fetch up to max_farms at a time, predict them in
+    one batch, then write them up to max_farms at a time.
+    Returns the stage timings by farm, or the error for failed farms.
+    """
+    time_start = time.time()
+    client = get_client()
     tz = 'Australia/Sydney'
     dt_format = 'YYYY-MM-DD HH:00:00'  # round to hour
     today = arrow.utcnow().to(tz).format(dt_format)
     yesterday = arrow.utcnow().to(tz).shift(days=-1).format(dt_format)
     dayafter = arrow.utcnow().to(tz).shift(days=+2).format(dt_format)
 
-    for farm in FARM_LIST:
-        print(f'Updating {farm}         ', end='\r', flush=True)
-        weather_update = get_weather(farm, yesterday, dayafter)
-        X, _ = transform_data(weather_update)
-        model = models[farm]
-        weather_update['prediction'] = np.clip(
-            model.predict(X), a_min=0.0, a_max=None)
-        update_db(farm, weather_update, upsert=True)
+    report = {farm: dict() for farm in FARM_LIST}
+    updates = run_farms(fetch_farm,
+                        {farm: (yesterday, today, dayafter)
+                         for farm in FARM_LIST},
+                        max_farms, report)
+
+    weather_updates = {farm: updates[farm][0] for farm in FARM_LIST
+                       if farm in updates}
+    if weather_updates:
+        predict_farms(weather_updates, report)
 
-        power_update = get_power(farm, yesterday, today)
-        update_db(farm, power_update, upsert=True)
+    run_farms(write_farm,
+              {farm: (client, weather_update, updates[farm][1],
+                      yesterday, dayafter)
+               for farm, weather_update in weather_updates.items()},
+              max_farms, report)
+    mark_update(client)
+
+    print(f'{"farm":<10}' + ''.join(f'{s:>15}' for s in STAGES))
+    for farm in FARM_LIST:
+        timings = report[farm]
+        if 'error' in timings:
+            print(f'{farm:<10}{"failed":>15}')
+        else:
+            print(f'{farm:<10}' +
+                  ''.join(f'{timings.get(s, 0):>14.3f}s' for s in STAGES))
 
     m, s = divmod(time.time()-time_start, 60)
     h, m = divmod(m, 60)
     runtime = '%03d:%02d:%02d' % (h, m, s)
     print(f'Done! Runtime: {runtime}')
 
+    return report
+
 
 if __name__ == '__main__':
     update_data()
@@ -1,32 +1,56 @@
-import os
-from compress_pickle import load
 import time
 
 import numpy as np
 import pandas as pd
 
-from models import MODEL_FILE, transform_data
-from data import FARM_LIST, update_db, connect_db, fetch_data
+from features import WEATHER_COL, build_features, weather_hash
+from metrics import timer
+from model_store import load_model, model_version
+from data import FARM_LIST, update_db, get_client, mark_update, fetch_data
 pd.options.mode.chained_assignment = None
 
-MONGO_URI = os.environ['MONGO_URI']
+CHUNK_SIZE = 5000
 
 
-def update_pred():
+def update_pred(incremental=True, chunksize=CHUNK_SIZE):
+    """Re-predict the history of all farms, chunksize rows at a time.
+    In incremental mode only rows predicted by another model version or
+    whose weather changed since the prediction are re-predicted.
+    """
     time_start = time.time()
-    client = connect_db(MONGO_URI)
-    models = load(open(MODEL_FILE, 'rb'))
+    client = get_client()
+    fields = WEATHER_COL + ['model_version', 'weather_hash']
 
     for farm in FARM_LIST:
-        print(f'Updating {farm}         ', end='\r', flush=True)
-        df = fetch_data(client, farm, limit=None)
-        X, _ = transform_data(df)
-        model = models[farm]
-
-        update_df = df[['time', 'prediction']].copy()
-        update_df['prediction'] = np.clip(
-            model.predict(X), a_min=0.0, a_max=None)
-        update_db(farm, update_df, upsert=True)
+        model = load_model(farm)
+        version = model_version(farm)
+        total, updated = 0, 0
+        for df in fetch_data(client, farm, fields=fields,
+                             chunksize=chunksize, columnar=True):
+            df = df.reindex(columns=['time'] + fields)
+            hashes = weather_hash(df)
+            total += len(df)
+            if incremental:
+                stale = ((df.model_version != version)
+                         | (df.weather_hash != hashes))
+                df, hashes = df[stale], hashes[stale]
+            if len(df) == 0:
+                continue
+
+            with timer('transform', farm):
+                X, _ = build_features(df)
+            update_df = df[['time']].copy()
+            with timer('predict', farm):
+                update_df['prediction'] = np.clip(
+                    model.inplace_predict(X, validate_features=False),
+                    a_min=0.0, a_max=None)
+            update_df['model_version'] = version
+            update_df['weather_hash'] = hashes
+            update_db(farm, update_df, upsert=True, client=client)
+            updated += len(df)
+
+        print(f'{farm}: re-predicted {updated} of {total} rows')
+    mark_update(client)
 
     m, s = divmod(time.time()-time_start, 60)
     h, m = divmod(m, 60)
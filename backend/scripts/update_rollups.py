@@ -0,0 +1,22 @@
+import time
+
+from data import FARM_LIST, get_client, mark_update
+from rollup import update_rollups
+
+
+def rebuild_rollups():
+    """Rebuild the rollups of all farms from their whole history."""
+    time_start = time.time()
+    client = get_client()
+    for farm in FARM_LIST:
+        update_rollups(client, farm)
+    mark_update(client)
+
+    m, s = divmod(time.time()-time_start, 60)
+    h, m = divmod(m, 60)
+    runtime = '%03d:%02d:%02d' % (h, m, s)
+    print(f'Done! Runtime: {runtime}')
+
+
+if __name__ == '__main__':
+    rebuild_rollups()
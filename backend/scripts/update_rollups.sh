@@ -0,0 +1,4 @@
+#!/bin/sh
+# run the script from backend root folder 
+
+python -m scripts.update_rollups
\ No newline at end of file
@@ -1,15 +1,13 @@
-import os
-
-import arrow
 import dash_bootstrap_components as dbc
 from dash import Dash, dcc, html
 from dash.dependencies import Input, Output, State
 from dash.html import Div
 from dash_bootstrap_components import Card, CardBody, CardHeader, Col, Row
-from pymongo import MongoClient
 
-from const import FARMS, TZ
-from plot import plot_forecast, plot_map, plot_weather
+from const import FARMS
+from db import get_farm_data, get_state_data, query_latest
+from timeconv import to_local
+from plot import plot_forecast, plot_map, plot_state, plot_weather
 
 app = Dash(__name__,
            meta_tags=[{'name': 'viewport',
@@ -18,8 +16,6 @@ app = Dash(__name__,
            )
 app.title = 'Wind Dashboard'
 
-MONGO_URI = os.environ.get('MONGO_URI')
-DB = MongoClient(MONGO_URI)['wpp']
 DEFAULT_FARM = list(FARMS.keys())[0]
 DEFAULT_DAY = 4 * 24
 FARM_OPTIONS = [{'label': v, 'value': k} for k, v in FARMS.items()]
@@ -28,7 +24,6 @@ RANGE_OPTIONS = [{'label': k, 'value': v} for k, v in
                   'Past 3 Months': ((2+90)*24), 'Past 6 Months': ((2+180)*24),
                   'Past Year': ((2+365)*24), 'All time': 0}.items()
                  ]
-TIME_FORMAT = 'YYYY-MM-DD HH:mm:SS'
 
 forecast_card = Card([
     CardHeader(id='plot-title', style={'height': '50px'}),
@@ -52,6 +47,17 @@ weather_info = Card(
     style={'margin': 5, 'height': '250px'},
     className='card border-primary')
 
+state_card = Card([
+    CardHeader(html.H5('Total wind power forecast in South Australia'),
+               style={'height': '50px'}),
+    CardBody(
+        dcc.Graph(
+            id='state-plot',
+            config={'displayModeBar': False},
+            style={'height': '250px'}
+        )
+    )], style={'margin': 5, 'height': '320px'}, className='card border-success')
+
 map_card = Card(
     [
         CardHeader(html.H5('Wind Farms in South Australia'),
@@ -136,6 +142,8 @@ app.layout = Div([
         ], lg=8, align='start'),
         Col(map_card, lg=4, align='start')
     ],
+        style={'width': '90%', 'margin': 'auto'}),
+    Row(Col(state_card),
         style={'width': '90%', 'margin': 'auto'})
 ])
 
@@ -151,17 +159,11 @@ def update_forecast_plot(farm, day):
     if not day:
         day = DEFAULT_DAY
 
-    projections = {'prediction': 1, 'actual': 1}
-    conn = DB[farm].find({}, projections).sort('_id', -1).limit(int(day))
-    data = list(conn)
+    data = get_farm_data(farm, day)
 
-    time = [d['_id'] for d in data]
-    time = [arrow.get(t).to(TZ).format(TIME_FORMAT) for t in time]
-    pred = [d['prediction'] for d in data]
-    actual = [d.get('actual') for d in data]
-    actual = [round(i, 2) if i is not None else None for i in actual]
+    time = to_local(data['time'])
 
-    return plot_forecast(time, pred, actual)
+    return plot_forecast(time, data['prediction'], data['actual'])
 
 
 @app.callback(
@@ -175,20 +177,27 @@ def update_weather_plot(farm, day):
     if not day:
         day = DEFAULT_DAY
 
-    projections = {'temperature': 1, 'wind_gust': 1,
-                   'wind_speed': 1, 'actual': 1}
-    conn = DB[farm].find({}, projections).sort('_id', -1).limit(int(day))
-    data = list(conn)
+    data = get_farm_data(farm, day)
 
-    time = [d['_id'] for d in data]
-    time = [arrow.get(t).to(TZ).format(TIME_FORMAT) for t in time]
-    actual = [d.get('actual') for d in data]
-    actual = [round(i, 2) if i is not None else None for i in actual]
-    temperature = [d.get('temperature') for d in data]
-    wind_gust = [d.get('wind_gust') for d in data]
-    wind_speed = [d.get('wind_speed') for d in data]
+    time = to_local(data['time'])
 
-    return plot_weather(time, actual, temperature, wind_gust, wind_speed)
+    return plot_weather(time, data['actual'], data['temperature'],
+                        data['wind_gust'], data['wind_speed'])
+
+
+@app.callback(
+    Output('state-plot', 'figure'),
+    Input('day-select', 'value')
+)
+def update_state_plot(day):
+    if not day:
+        day = DEFAULT_DAY
+
+    data = get_state_data(day)
+    time = to_local(data['time'])
+    contributions = {FARMS[farm]: data[f'farm:{farm}'] for farm in FARMS}
+
+    return plot_state(time, data['prediction'], data['actual'], contributions)
 
 
 @app.callback(
@@ -209,17 +218,23 @@ def update_plot_title(farm):
 def update_weather(farm):
     if not farm:
         farm = DEFAULT_FARM
-    filters = {"actual": {"$exists": "true"}}
-    projections = {'icon': 1,  'temperature': 1,
-                   'wind_gust': 1, 'wind_speed': 1}
-
-    conn = DB[farm].find(filters, projections).sort('_id', -1).limit(1)
-    data = list(conn)[0]
-
-    icon = data.get('icon')
-    temp = data['temperature']
-    wind = data['wind_speed']
-    gust = data['wind_gust']
+    # The latest hour with power data, from the default range of the farm
+    data = get_farm_data(farm, DEFAULT_DAY)
+    i = next((i for i, a in enumerate(data['actual']) if a is not None),
+             None)
+    if i is not None:
+        latest = {field: values[i] for field, values in data.items()}
+    else:
+        # No power data in the range, look further back
+        latest = query_latest(farm)
+    if latest is None:
+        return [html.H5(f'Current Weather:'),
+                html.P('No recent weather data.')]
+
+    icon = latest['icon']
+    temp = latest['temperature']
+    wind = latest['wind_speed']
+    gust = latest['wind_gust']
 
     if not icon:
         icon = 'default'
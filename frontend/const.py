@@ -1,16 +1,4 @@
-FARMS = {'BLUFF1': 'Bluff Wind Farm',
-         'CATHROCK': 'Cathedral Rocks Wind Farm',
-         'CLEMGPWF': 'Clements Gap Wind Farm',
-         'HALLWF2': 'Hallett 2 Wind Farm',
-         'HDWF2': 'Hornsdale Wind Farm 2',
-         'LKBONNY2': 'Lake Bonney Stage 2 Wind Farm',
-         'MTMILLAR': 'Mt Millar Wind Farm',
-         'NBHWF1': 'North Brown Hill Wind Farm',
-         'SNOWNTH1': 'Snowtown Wind Farm Stage 2 North',
-         'SNOWSTH1': 'Snowtown South Wind Farm',
-         'STARHLWF': 'Starfish Hill Wind Farm',
-         'WATERLWF': 'Waterloo Wind Farm',
-         'WPWF': 'Wattle Point Wind Farm'}
+from farms import FARMS
 
 TZ = 'Australia/Sydney'
 
@@ -0,0 +1,209 @@
+"""Shared, cached access to the farm collections for the Dash callbacks.
+Each (farm, range) is read with projected queries, the history from the
+coarsest rollup that still gives MIN_POINTS points & the forecast hours
+from the hourly collection, and kept in an LRU cache
+bounded in bytes. The cache is cleared when the backend records a
+new hourly update, and entries expire after CACHE_TTL seconds anyway.
+"""
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from pymongo import MongoClient
+
+from farms import FARMS
+
+MONGO_URI = os.environ.get('MONGO_URI')
+DB = MongoClient(MONGO_URI)['wpp']
+FIELDS = ['prediction', 'actual', 'icon',
+          'temperature', 'wind_gust', 'wind_speed']
+ROLLUP_FIELDS = ['prediction', 'actual',
+                 'temperature', 'wind_gust', 'wind_speed']
+# Rollup collections maintained by the backend, coarsest first
+ROLLUPS = [('weekly', 7 * 24), ('daily', 24)]
+MIN_POINTS = 60
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 3600
+CHECK_INTERVAL = 60  # seconds between checks for a new hourly update
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # (farm, day) -> (fetch time, size, data)
+_key_locks = dict()
+_state = {'bytes': 0, 'checked': 0.0, 'last_update': None}
+
+
+def sizeof(data):
+    """Approximate size in bytes of the lists in data."""
+    return sum(sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+               for values in data.values())
+
+
+def pick_rollup(day):
+    """Return the coarsest (rollup, hours) with MIN_POINTS points in the
+    range, or (None, 1) for the hourly data. All time is judged by the
+    first farm, so every farm gets the same time grid.
+    """
+    for rollup, hours in ROLLUPS:
+        if day:
+            points = day / hours
+        else:
+            reference = next(iter(FARMS))
+            points = DB[f'{reference}_{rollup}'].estimated_document_count()
+        if points >= MIN_POINTS:
+            return rollup, hours
+    return None, 1
+
+
+def read_docs(collection, fields, query, limit):
+    """Read the newest limit documents matching query as lists by hourly
+    field, fields maps each to its name in the collection.
+    """
+    projections = {field: 1 for field in fields.values()}
+    docs = list(collection.find(query, projections)
+                .sort('_id', -1).limit(limit))
+
+    data = {'time': [d['_id'] for d in docs]}
+    for field in FIELDS:
+        source = fields.get(field)
+        data[field] = [d.get(source) for d in docs]
+    return data
+
+
+def query_farm(farm, day):
+    """Read the last day hours of a farm, day=0 reads all. Rollups are
+    returned under the hourly field names, using the mean of each period,
+    with the forecast hours after the latest actual joined on from the
+    hourly collection.
+    """
+    rollup, hours = pick_rollup(day)
+    limit = math.ceil(day / hours)
+    hourly_fields = {f: f for f in FIELDS}
+    if rollup is None:
+        return read_docs(DB[farm], hourly_fields, {}, limit)
+
+    # Rollup periods end at the latest actual, the hours after it are the
+    # forecast & come from the hourly collection
+    latest = DB[farm].find_one({'actual': {'$ne': None}}, {'_id': 1},
+                               sort=[('_id', -1)])
+    query = {} if latest is None else {'_id': {'$lte': latest['_id']}}
+    data = read_docs(DB[f'{farm}_{rollup}'],
+                     {f: f'{f}_mean' for f in ROLLUP_FIELDS}, query, limit)
+    if latest is not None:
+        forecast = read_docs(DB[farm], hourly_fields,
+                             {'_id': {'$gt': latest['_id']}}, 0)
+        data = {field: forecast[field] + data[field] for field in data}
+    return data
+
+
+def query_latest(farm):
+    """Return the fields of the latest hour of a farm with power data, or
+    None if it has none.
+    """
+    data = read_docs(DB[farm], {f: f for f in FIELDS},
+                     {'actual': {'$ne': None}}, 1)
+    if not data['time']:
+        return None
+    return {field: values[0] for field, values in data.items()}
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+        _state['bytes'] = 0
+
+
+def check_update():
+    """Clear the cache if the backend recorded a newer hourly update."""
+    now = time.time()
+    if now - _state['checked'] < CHECK_INTERVAL:
+        return
+    _state['checked'] = now
+    marker = DB['meta'].find_one({'_id': 'last_update'}) or {}
+    if marker.get('time') != _state['last_update']:
+        _state['last_update'] = marker.get('time')
+        clear_cache()
+
+
+def _get_cached(key):
+    entry = _cache.get(key)
+    if entry and time.time() - entry[0] < CACHE_TTL:
+        _cache.move_to_end(key)
+        return entry[2]
+    return None
+
+
+def _put(key, data):
+    size = sizeof(data)
+    if key in _cache:
+        _state['bytes'] -= _cache.pop(key)[1]
+    _cache[key] = (time.time(), size, data)
+    _state['bytes'] += size
+    # Evict the least recently used entries, but always keep the new one
+    while _state['bytes'] > CACHE_BYTES and len(_cache) > 1:
+        _, (_, evicted, _) = _cache.popitem(last=False)
+        _state['bytes'] -= evicted
+
+
+def cached(key, load):
+    """Return the cached data of key, calling load() on a miss. Concurrent
+    misses of the same key wait for a single load.
+    """
+    check_update()
+    with _lock:
+        data = _get_cached(key)
+        if data is not None:
+            return data
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    with key_lock:
+        with _lock:
+            data = _get_cached(key)
+        if data is None:
+            data = load()
+            with _lock:
+                _put(key, data)
+    return data
+
+
+def get_farm_data(farm, day):
+    """Return the last day hours of a farm (all if day is 0) as lists by
+    field, newest first.
+    """
+    return cached((farm, int(day)), lambda: query_farm(farm, int(day)))
+
+
+def aggregate_farms(day):
+    """Fetch all farms concurrently, align them on _id & sum them up. An
+    hour missing from any farm has no total, rather than a partial one.
+    """
+    with ThreadPoolExecutor(max_workers=len(FARMS)) as executor:
+        farm_data = dict(zip(FARMS, executor.map(
+            lambda farm: get_farm_data(farm, day), FARMS)))
+
+    frames = {farm: pd.DataFrame(
+        {'prediction': data['prediction'], 'actual': data['actual']},
+        index=data['time'], dtype='float64')
+        for farm, data in farm_data.items()}
+    df = pd.concat(frames, axis=1).sort_index(ascending=False)
+    prediction = df.xs('prediction', axis=1, level=1)
+    actual = df.xs('actual', axis=1, level=1)
+
+    data = {'time': df.index.tolist(),
+            'prediction': prediction.sum(
+                axis=1, min_count=len(FARMS)).tolist(),
+            'actual': actual.sum(axis=1, min_count=len(FARMS)).tolist()}
+    for farm in FARMS:
+        data[f'farm:{farm}'] = actual[farm].tolist()
+    return data
+
+
+def get_state_data(day):
+    """Return the prediction & actual summed over all farms, newest first,
+    with each farm's actual under 'farm:<DUID>'.
+    """
+    return cached(('ALL', int(day)), lambda: aggregate_farms(int(day)))
@@ -0,0 +1,46 @@
+"""Downsample long series before they are sent to the browser."""
+import numpy as np
+
+# The widest the plots get on a desktop screen
+PLOT_WIDTH = 1200
+POINTS_PER_PX = 2
+
+
+def to_array(values, decimals=2):
+    """Convert a list with None to a rounded float array with NaN."""
+    return np.round(np.array(values, dtype='float64'), decimals)
+
+
+def leading_missing(values):
+    """Count the NaN before the first value, i.e. the forecast hours."""
+    present = ~np.isnan(values)
+    return int(np.argmax(present)) if present.any() else len(values)
+
+
+def minmax_indices(values, n_out):
+    """Indices of the min & max of values in each of n_out/2 equal buckets,
+    in order. A bucket with only NaN keeps its first point, so gaps stay
+    visible. Short series are returned whole.
+    """
+    n = len(values)
+    if n <= n_out:
+        return np.arange(n)
+    n_buckets = max(n_out // 2, 1)
+    size = -(-n // n_buckets)  # ceil
+
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = values
+    buckets = padded.reshape(n_buckets, size)
+    offsets = np.arange(n_buckets) * size
+    lows = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    highs = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+
+    idx = np.unique(np.concatenate([offsets + lows, offsets + highs,
+                                    [0, n - 1]]))
+    return idx[idx < n]
+
+
+def history_indices(values, latest, n_out):
+    """Keep the forecast [:latest] whole & downsample the history after it."""
+    return np.concatenate([np.arange(latest),
+                           latest + minmax_indices(values[latest:], n_out)])
@@ -1,11 +1,12 @@
-import csv
 import os
-import urllib.request
 
+import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
-from const import FARMS
+from downsample import (PLOT_WIDTH, POINTS_PER_PX, history_indices,
+                        leading_missing, minmax_indices, to_array)
+from farms import load_farms
 
 # define some common stylings
 COLORS = ['#636EFA', '#EF553B', '#00CC96',
@@ -35,17 +36,11 @@ url_suffix = '.gif'
 
 
 def plot_map():
-    farm_overview = 'https://services.aremi.data61.io/aemo/v6/csv/wind'
-    response = urllib.request.urlopen(farm_overview)
-    lines = [l.decode('utf-8') for l in response.readlines()]
-    data_rows = list(csv.reader(lines))
-    rows = data_rows[1:]
-
-    data = [row for row in rows if row[20] in FARMS.keys()]
-    names = [d[0] for d in data]
-    power = [float(d[1]) for d in data]
-    lat = [round(float(d[21]), 3) for d in data]
-    lon = [round(float(d[22]), 3) for d in data]
+    farms = load_farms().values()
+    names = [f.name for f in farms]
+    power = [f.power for f in farms]
+    lat = [round(f.lat, 3) for f in farms]
+    lon = [round(f.lon, 3) for f in farms]
 
     fig = go.Figure(go.Scattermapbox(
         lat=lat,
@@ -80,30 +75,83 @@ def plot_map():
     return fig
 
 
-def plot_forecast(time, pred, actual):
-    latest = len([i for i in actual if i is None])
+def plot_forecast(time, pred, actual, max_points=POINTS_PER_PX*PLOT_WIDTH):
+    time = np.asarray(time)
+    pred = to_array(pred)
+    actual = to_array(actual)
+    latest = leading_missing(actual)
+    # Forecast hours are kept whole, the history is downsampled per trace
+    forecast = np.arange(min(latest+1, len(time)))
+    pred_idx = latest + minmax_indices(pred[latest:], max_points)
+    actual_idx = history_indices(actual, latest, max_points)
+
     fig = go.Figure()
 
     # Plot the dashed line first, hide their legends, then plot solid lines and
     # show legends. Legneds are grouped so they can be hide/unhide at same time
     fig.add_trace(go.Scatter(
-        x=time[:latest+1],
-        y=[round(i, 2) for i in pred[:latest+1]],
+        x=time[forecast],
+        y=pred[forecast],
         name='Prediction (Forecast)',
         legendgroup='Forecast',
         showlegend=False,
         line={'dash': 'dash', 'color': COLORS[1]}
     ))
+    fig.add_trace(go.Scatter(
+        x=time[actual_idx],
+        y=actual[actual_idx],
+        name='Actual',
+        legendgroup='Actual',
+        line={'dash': 'solid', 'color': COLORS[0]}
+    ))
+    fig.add_trace(go.Scatter(
+        x=time[pred_idx],
+        y=pred[pred_idx],
+        name='Prediction',
+        legendgroup='Forecast',
+        line={'dash': 'solid', 'color': COLORS[1]}
+    ))
+
+    fig.update_yaxes(ticksuffix=' MW', tickangle=45, **grid_colors)
+    fig.update_xaxes(**grid_colors)
+    fig.update_layout(
+        margin=dict(l=10, r=10, t=10, b=10),
+        **line_plot_layout,
+    )
+
+    return fig
+
+
+def plot_state(time, pred, actual, contributions):
+    """Plot the total of all farms, with the actual of each farm stacked."""
+    time = np.asarray(time)
+    pred = to_array(pred)
+    actual = to_array(actual)
+    fig = go.Figure()
+
+    for i, (name, values) in enumerate(contributions.items()):
+        fig.add_trace(go.Scatter(
+            x=time,
+            y=to_array(values),
+            name=name,
+            legendgroup='Farms',
+            stackgroup='farms',
+            mode='none',
+            fillcolor=COLORS[i % len(COLORS)],
+            opacity=0.5,
+            showlegend=False,
+            hoverinfo='skip'
+        ))
     fig.add_trace(go.Scatter(
         x=time,
-        y=[round(i, 2) if i is not None else None for i in actual],
+        y=actual,
         name='Actual',
         legendgroup='Actual',
         line={'dash': 'solid', 'color': COLORS[0]}
     ))
     fig.add_trace(go.Scatter(
-        x=time[latest:],
-        y=[round(i, 2) if i is not None else None for i in pred[latest:]],
+        x=time,
+        y=pred,
         name='Prediction',
         legendgroup='Forecast',
         line={'dash': 'solid', 'color': COLORS[1]}
@@ -123,57 +171,36 @@ def format_title(s):
     return ' '.join([w.capitalize() for w in s.split('_')])
 
 
-def plot_weather(time, actual, temperature, wind_gust, wind_speed):
-    latest = len([i for i in actual if i is None])
+def plot_weather(time, actual, temperature, wind_gust, wind_speed,
+                 max_points=POINTS_PER_PX*PLOT_WIDTH//2):
+    time = np.asarray(time)
+    latest = leading_missing(to_array(actual))
+    forecast = np.arange(min(latest+1, len(time)))
     fig = make_subplots(rows=1, cols=2, horizontal_spacing=0.1)
 
     # Plot the dashed line first, hide their legends, then plot solid lines and
     # show legends. Legneds are grouped so they can be hide/unhide at same time
-    fig.add_trace(go.Scatter(
-        x=time[:latest+1],
-        y=wind_speed[:latest+1],
-        name='Wind (Forecast)',
-        legendgroup='Wind',
-        showlegend=False,
-        line={'dash': 'dash', 'color': COLORS[2]}
-    ), row=1, col=1)
-    fig.add_trace(go.Scatter(
-        x=time[:latest+1],
-        y=wind_gust[:latest+1],
-        name='Gust (Forecast)',
-        legendgroup='Gust',
-        showlegend=False,
-        line={'dash': 'dash', 'color': COLORS[3]}
-    ), row=1, col=1)
-    fig.add_trace(go.Scatter(
-        x=time[:latest+1],
-        y=temperature[:latest+1],
-        name='Temp (Forecast)',
-        legendgroup='Temp',
-        showlegend=False,
-        line={'dash': 'dash', 'color': COLORS[4]}
-    ), row=1, col=2)
-    fig.add_trace(go.Scatter(
-        x=time[latest:],
-        y=wind_speed[latest:],
-        name='Wind',
-        legendgroup='Wind',
-        line={'dash': 'solid', 'color': COLORS[2]}
-    ), row=1, col=1)
-    fig.add_trace(go.Scatter(
-        x=time[latest:],
-        y=wind_gust[latest:],
-        name='Gust',
-        legendgroup='Gust',
-        line={'dash': 'solid', 'color': COLORS[3]}
-    ), row=1, col=1)
-    fig.add_trace(go.Scatter(
-        x=time[latest:],
-        y=temperature[latest:],
-        name='Temp',
-        legendgroup='Temp',
-        line={'dash': 'solid', 'color': COLORS[4]}
-    ), row=1, col=2)
+    series = [('Wind', to_array(wind_speed), COLORS[2], 1),
+              ('Gust', to_array(wind_gust), COLORS[3], 1),
+              ('Temp', to_array(temperature), COLORS[4], 2)]
+    for name, values, color, col in series:
+        fig.add_trace(go.Scatter(
+            x=time[forecast],
+            y=values[forecast],
+            name=f'{name} (Forecast)',
+            legendgroup=name,
+            showlegend=False,
+            line={'dash': 'dash', 'color': color}
+        ), row=1, col=col)
+    for name, values, color, col in series:
+        idx = latest + minmax_indices(values[latest:], max_points)
+        fig.add_trace(go.Scatter(
+            x=time[idx],
+            y=values[idx],
+            name=name,
+            legendgroup=name,
+            line={'dash': 'solid', 'color': color}
+        ), row=1, col=col)
 
     fig.update_yaxes(row=1, col=1, ticksuffix=' m/s',
                      tickangle=45, **grid_colors)
@@ -0,0 +1,31 @@
+"""Convert document _ids (UTC) to local time strings for the plots."""
+import numpy as np
+import pandas as pd
+
+from const import TZ
+
+MEMO_SIZE = 200000
+_memo = dict()  # (tz, UTC string) -> local string
+
+
+def to_local(times, tz=TZ):
+    """Convert UTC '%Y-%m-%d %H:%M:%S' strings to local time strings in tz.
+    Timestamps converted before are looked up, the rest are converted in
+    one vectorized pass, which handles DST through the tz database.
+    """
+    times = pd.Series(times, dtype=object)
+    local = pd.Series([_memo.get((tz, t)) for t in times], dtype=object)
+    missing = local.isna().values
+    if missing.any():
+        new = times[missing]
+        utc = pd.to_datetime(new, format='%Y-%m-%d %H:%M:%S', utc=True)
+        naive = utc.dt.tz_convert(tz).dt.tz_localize(None)
+        strings = np.char.replace(np.datetime_as_string(
+            naive.values.astype('datetime64[s]'), unit='s'), 'T', ' ')
+        local[missing] = strings
+
+        if len(_memo) + len(new) > MEMO_SIZE:
+            _memo.clear()
+        _memo.update(zip(((tz, t) for t in new), strings))
+
+    return local.values